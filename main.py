@@ -5,26 +5,52 @@ main.py
 FastAPI application for ERP-Notion comparison with web interface.
 """
 
-from fastapi import FastAPI, HTTPException, Request, Form
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi import FastAPI, HTTPException, Request, Response, Form
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import HTMLResponse, JSONResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from pydantic import BaseModel
 import asyncio
+import collections
+import concurrent.futures
+from contextlib import asynccontextmanager
+import itertools
 import logging
+import orjson
+import os
+import re
 from typing import Optional, Dict, Any
 import time
-from datetime import datetime
+import uuid
 import threading
 
 # Import our comparison logic
-from merge_compare import gather_erp_data, gather_notion_data, compare_with_claude, create_shared_google_sheet, split_large_text
+import merge_compare as mc
+from merge_compare import gather_erp_data, gather_notion_data, compare_batch_with_claude, create_shared_google_sheet, split_large_text
+from merge_compare import dumps_pretty, replace_logical_operators, normalize_booleans
 from dotenv import load_dotenv
 
 # Load environment variables
 load_dotenv()
 
-app = FastAPI(title="ERP-Notion Comparison Tool", version="1.0.0")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Share one pooled HTTP session across all requests for the app's lifetime."""
+    session = mc.new_http_session()
+    mc.set_http_session(session)
+    try:
+        yield
+    finally:
+        session.close()
+
+class ORJSONResponse(JSONResponse):
+    """JSON response rendered with orjson (progress is polled/streamed often)."""
+
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+
+app = FastAPI(title="ERP-Notion Comparison Tool", version="1.0.0", default_response_class=ORJSONResponse, lifespan=lifespan)
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
@@ -36,6 +62,7 @@ templates = Jinja2Templates(directory="templates")
 class ComparisonRequest(BaseModel):
     page_id: Optional[str] = None
     prompt_name: Optional[str] = None
+    force_refresh: bool = False  # Bypass the fetch cache
 
 class ComparisonResponse(BaseModel):
     success: bool
@@ -43,321 +70,660 @@ class ComparisonResponse(BaseModel):
     sheet_url: Optional[str] = None
     summary: Optional[Dict[str, Any]] = None
 
-# Global progress tracking
-progress_data = {
-    "current_step": "",
-    "progress_percentage": 0,
-    "logs": [],
-    "status": "idle"  # idle, running, completed, error, cancelled
-}
+# Notion page/database id: 32 hex digits, optionally in dashed UUID form
+_NOTION_ID_RE = re.compile(r"[0-9a-fA-F]{8}-?[0-9a-fA-F]{4}-?[0-9a-fA-F]{4}-?[0-9a-fA-F]{4}-?[0-9a-fA-F]{12}")
+
+def extract_notion_id(page_id: str) -> str:
+    """Return the raw id from a Notion URL (or the input itself if none is found).
+
+    The query string is dropped first because ``?v=`` carries a *view* id;
+    the last id in the path wins since slugs look like ``Title-<id>``.
+    """
+    path = page_id.partition("?")[0]
+    matches = _NOTION_ID_RE.findall(path)
+    if matches:
+        return matches[-1]
+    return path.rpartition("/")[2] if "notion.so" in page_id else page_id
+
+# Only the most recent log entries are kept so long runs don't grow memory
+PROGRESS_LOG_LIMIT = 500
+
+def _new_progress_state() -> Dict[str, Any]:
+    """Fresh progress state; ``log_count`` counts every entry ever appended."""
+    return {
+        "current_step": "",
+        "progress_percentage": 0,
+        "logs": collections.deque(maxlen=PROGRESS_LOG_LIMIT),
+        "log_count": 0,
+        "status": "idle"  # idle, running, completed, error, cancelled
+    }
 
-# Global cancellation flag – set by /api/stop or browser unload
-cancel_event = threading.Event()
+# Global progress tracking
+progress_data = _new_progress_state()
+
+# Guards progress_data: worker threads write while /api/progress reads
+_progress_lock = threading.Lock()
+# Bumped on every change to progress_data (never reset), so identical polls
+# can be answered with the previously serialised JSON
+_progress_version = 0
+_progress_json_cache: Optional[tuple[tuple, bytes]] = None
+# Makes ETags from a previous process (whose version restarted at 0) never match
+_progress_etag_prefix = uuid.uuid4().hex[:8]
+
+# Open /api/progress/stream connections as (event loop, asyncio.Event) pairs;
+# writers wake them from worker threads via call_soon_threadsafe
+_progress_subscribers: set = set()
+
+# Background comparison jobs by id:
+# {"status": "running" | "finished", "result": ComparisonResponse, "cancel_event": threading.Event}.
+# Every job gets its own cancel event, so work a cancelled run leaves behind
+# stays cancelled when the next run starts.
+# Only the most recent MAX_FINISHED_JOBS are kept; task refs stop the
+# running asyncio tasks from being garbage-collected mid-flight.
+MAX_FINISHED_JOBS = 20
+comparison_jobs: Dict[str, Dict[str, Any]] = {}
+_job_tasks: set = set()
+
+# (epoch second, "HH:MM:SS") of the last log timestamp, rebuilt once per second
+_ts_cache = [0, ""]
+
+def _log_timestamp() -> str:
+    """Local ``HH:MM:SS`` for a log entry, formatted at most once per second.
+
+    Called with ``_progress_lock`` held, so the cache is never updated concurrently.
+    """
+    now = int(time.time())
+    if now != _ts_cache[0]:
+        _ts_cache[1] = time.strftime("%H:%M:%S", time.localtime(now))
+        _ts_cache[0] = now
+    return _ts_cache[1]
 
 def update_progress(step: str, percentage: int, log_message: str = None):
-    """Update global progress state"""
-    global progress_data
-    progress_data["current_step"] = step
-    progress_data["progress_percentage"] = max(0, min(100, percentage))
-    progress_data["status"] = "running"
-    
-    if log_message:
-        timestamp = datetime.now().strftime("%H:%M:%S")
-        progress_data["logs"].append({
-            "timestamp": timestamp,
-            "message": log_message,
-            "type": "info"
-        })
+    """Update global progress state.
+
+    Safe to call from several worker threads at once (Notion and ERP are
+    fetched concurrently); the percentage never moves backwards while a run
+    is in progress so interleaved updates don't make the bar jump around.
+    Calls that would change nothing observable return without notifying
+    the stream subscribers.
+    """
+    global _progress_version
+    with _progress_lock:
+        new_percentage = max(progress_data["progress_percentage"], max(0, min(100, int(percentage))))
+        if (not log_message
+                and progress_data["current_step"] == step
+                and progress_data["progress_percentage"] == new_percentage
+                and progress_data["status"] == "running"):
+            return
+        progress_data["current_step"] = step
+        progress_data["progress_percentage"] = new_percentage
+        progress_data["status"] = "running"
+        _progress_version += 1
+        
+        if log_message:
+            timestamp = _log_timestamp()
+            progress_data["logs"].append({
+                "timestamp": timestamp,
+                "message": log_message,
+                "type": "info"
+            })
+            progress_data["log_count"] += 1
     
-    logger.info(f"Progress: {step} - {percentage}% - {log_message}")
+    _notify_progress_subscribers()
+    logger.debug("Progress: %s - %s%% - %s", step, percentage, log_message)
+
+# Minimum seconds between per-item progress log entries in the row loops
+PROGRESS_MIN_INTERVAL = 0.25
+
+def _make_progress_throttle(interval: float = PROGRESS_MIN_INTERVAL):
+    """Return ``due(final=False)``: true at most once per *interval*, and always when *final*."""
+    last_emit = 0.0
+
+    def due(final: bool = False) -> bool:
+        nonlocal last_emit
+        now = time.monotonic()
+        if final or now - last_emit >= interval:
+            last_emit = now
+            return True
+        return False
+
+    return due
+
+def _notify_progress_subscribers():
+    """Wake every SSE stream so it pushes the latest progress delta."""
+    with _progress_lock:
+        subscribers = list(_progress_subscribers)
+    for loop, changed in subscribers:
+        try:
+            loop.call_soon_threadsafe(changed.set)
+        except RuntimeError:
+            pass  # Loop already closed – the stream is going away
+
+def set_progress_status(status: str):
+    """Set the run status (completed, cancelled, …) under the progress lock."""
+    global _progress_version
+    with _progress_lock:
+        progress_data["status"] = status
+        _progress_version += 1
+    _notify_progress_subscribers()
+
+def get_progress_snapshot(since: int = 0, tail: Optional[int] = None) -> Dict[str, Any]:
+    """Return a consistent copy of the progress state for serialisation.
+
+    Only log entries from absolute index *since* onwards are included (at
+    most the last *tail* of them); ``log_count`` tells the client where to
+    resume. A *since* beyond ``log_count`` means a new run has started and
+    the retained log is returned from the beginning.
+    """
+    with _progress_lock:
+        return _progress_snapshot_locked(since, tail)
+
+def _progress_snapshot_locked(since: int, tail: Optional[int]) -> Dict[str, Any]:
+    """Body of ``get_progress_snapshot``; the caller must hold ``_progress_lock``."""
+    logs = progress_data["logs"]
+    log_count = progress_data["log_count"]
+    if since > log_count:
+        since = 0
+    # Entries older than the deque's window have already been dropped
+    skip = max(0, since - (log_count - len(logs)))
+    new_logs = list(itertools.islice(logs, skip, None))
+    if tail is not None:
+        new_logs = new_logs[-tail:] if tail > 0 else []
+    return {**progress_data, "logs": new_logs}
+
+def get_progress_json(since: int = 0, tail: Optional[int] = None) -> bytes:
+    """Serialised ``get_progress_snapshot``, reused until progress next changes."""
+    global _progress_json_cache
+    with _progress_lock:
+        key = (_progress_version, since, tail)
+        cached = _progress_json_cache
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        snapshot = _progress_snapshot_locked(since, tail)
+    body = orjson.dumps(snapshot)
+    _progress_json_cache = (key, body)
+    return body
+
+def get_progress_etag() -> str:
+    """Entity tag of the current progress state (changes whenever it does)."""
+    return f'"{_progress_etag_prefix}-{_progress_version}"'
 
 def reset_progress():
     """Reset progress state"""
-    global progress_data
-    progress_data = {
-        "current_step": "",
-        "progress_percentage": 0,
-        "logs": [],
-        "status": "idle"
-    }
-    cancel_event.clear()
+    global progress_data, _progress_version
+    with _progress_lock:
+        progress_data = _new_progress_state()
+        _progress_version += 1
+    _notify_progress_subscribers()
 
 @app.get("/", response_class=HTMLResponse)
 async def home(request: Request):
     """Serve the main comparison interface."""
     return templates.TemplateResponse("index.html", {"request": request})
 
-@app.post("/api/compare", response_model=ComparisonResponse)
-async def compare_data(request: ComparisonRequest):
-    """Run the ERP-Notion comparison process *without* blocking the event loop.
-
-    The heavy synchronous work is executed in a background thread via
-    ``asyncio.to_thread`` so that the main asyncio event-loop remains free to
-    serve the ``/api/progress`` polling requests coming from the browser.  This
-    guarantees that the UI can receive real-time updates while the comparison
-    is still running.
+class ComparisonJob:
+    """Inputs and row accumulators for one comparison run."""
+
+    def __init__(self, page_id: Optional[str], prompt_name: Optional[str], cancel_event: threading.Event,
+                 force_refresh: bool = False):
+        self.page_id = page_id
+        self.prompt_name = prompt_name
+        self.cancel_event = cancel_event
+        self.force_refresh = force_refresh
+        self.data_rows: list[list[str]] = []
+        self.section_headers: list[int] = []  # Row indices of the section headers
+
+# Fetched records per source, reused by reruns within FETCH_CACHE_TTL
+# seconds (0, the default, disables it – the UI has no refresh control):
+# {(source, key): (fetched_at, records)}, oldest first
+FETCH_CACHE_TTL = float(os.getenv("FETCH_CACHE_TTL", "0"))
+FETCH_CACHE_SIZE = 32
+_fetch_cache: "collections.OrderedDict[tuple, tuple[float, list[dict]]]" = collections.OrderedDict()
+_fetch_cache_lock = threading.Lock()
+
+def _prune_fetch_cache_locked() -> None:
+    """Drop expired entries (oldest first); the caller must hold ``_fetch_cache_lock``."""
+    cutoff = time.monotonic() - FETCH_CACHE_TTL
+    while _fetch_cache and next(iter(_fetch_cache.values()))[0] <= cutoff:
+        _fetch_cache.popitem(last=False)
+
+def _prune_fetch_cache() -> None:
+    """Release records whose TTL has passed so an idle server doesn't keep them."""
+    with _fetch_cache_lock:
+        _prune_fetch_cache_locked()
+
+def _cached_fetch(cache_key: tuple, fetch, force_refresh: bool = False) -> tuple[list[dict], bool]:
+    """Return ``(records, from_cache)``, calling ``fetch(failed)`` only on a miss.
+
+    Records are never mutated downstream, so cached lists are shared as-is.
+    Only complete fetches are cached: *fetch* appends whatever it could not
+    retrieve to *failed*, and a run cancelled mid-fetch returns a partial
+    list, so neither (nor an empty result) is replayed to the next run.
     """
-    
-    # ---------------------------------------------------------------
-    # 1. Validate request payload early – run on event-loop thread
-    # ---------------------------------------------------------------
-    if not request.page_id and not request.prompt_name:
-        raise HTTPException(
-            status_code=400, 
-            detail="At least one data source must be provided (page_id or prompt_name)",
+    if FETCH_CACHE_TTL > 0 and not force_refresh:
+        with _fetch_cache_lock:
+            _prune_fetch_cache_locked()
+            hit = _fetch_cache.get(cache_key)
+            if hit is not None and time.monotonic() - hit[0] < FETCH_CACHE_TTL:
+                return hit[1], True
+
+    failed: list = []
+    records = fetch(failed)
+    if failed:
+        logger.warning("%s fetch incomplete: %d item(s) could not be retrieved", cache_key[0], len(failed))
+    cancelled = mc.cancel_event is not None and mc.cancel_event.is_set()
+    if FETCH_CACHE_TTL > 0 and records and not failed and not cancelled:
+        with _fetch_cache_lock:
+            _fetch_cache[cache_key] = (time.monotonic(), records)
+            _fetch_cache.move_to_end(cache_key)
+            while len(_fetch_cache) > FETCH_CACHE_SIZE:
+                _fetch_cache.popitem(last=False)
+    return records, False
+
+def _fetch_notion(database_url: Optional[str], force_refresh: bool = False) -> list[dict]:
+    """Fetch the Notion records, reporting progress; an empty list on failure."""
+    try:
+        update_progress("Fetching Notion data", 5, "Connecting to Notion database…")
+        records, cached = _cached_fetch(
+            ("notion", database_url), lambda failed: gather_notion_data(database_url, failed), force_refresh
         )
-
-    # ---------------------------------------------------------------
-    # 2. Define the **blocking** worker function
-    # ---------------------------------------------------------------
-    def _perform_comparison(page_id: str | None, prompt_name: str | None) -> ComparisonResponse:
-        """Synchronous worker executed in a thread."""
-
-        logger.info("Starting comparison process…")
-        start_time = time.time()
-        
-        # Dynamically update merge_compare globals (safe inside the worker thread)
-        import merge_compare as mc
-        if prompt_name:
-            mc.PROMPT_NAME = prompt_name
-        if page_id:
-            # Extract raw ID if a full Notion URL is provided
-            nid = (
-                page_id.split("/")[-1].split("?")[0] if "notion.so" in page_id else page_id
-            )
-            mc.DATABASE_URL = f"https://www.notion.so/{nid}"
-        
-        # Reset + initialise progress
-        reset_progress()
-        update_progress("Initializing validation process", 2, "Starting ECP validation…")
-        # Clear any previous cancel signal
-        cancel_event.clear()
-
-        # Register callback so helper functions can push granular updates
-        mc.set_progress_callback(update_progress)
-        mc.set_cancel_event(cancel_event)
-
-        # -------------------------------------------------------
-        # 2.a Fetch Notion data
-        # -------------------------------------------------------
-        notion_records: list[dict] = []
-        if page_id:
-            try:
-                update_progress("Fetching Notion data", 5, "Connecting to Notion database…")
-                notion_records = gather_notion_data()
-                update_progress(
-                    "Fetching Notion data",
-                    65,
-                    f"Retrieved {len(notion_records)} Notion records",
-                )
-            except Exception as exc:
-                logger.warning("Notion fetch failed: %s", exc)
-        
-        # -------------------------------------------------------
-        # 2.b Fetch ERP data
-        # -------------------------------------------------------
-        erp_records: list[dict] = []
-        if prompt_name:
-            try:
-                update_progress("Fetching ERP data", 70, "Connecting to ERP system…")
-                erp_records = gather_erp_data()
-                update_progress(
-                    "Fetching ERP data",
-                    80,
-                    f"Retrieved {len(erp_records)} ERP records",
-                )
-            except Exception as exc:
-                logger.warning("ERP fetch failed: %s", exc)
-        
-        if not notion_records and not erp_records:
-            return ComparisonResponse(
-                success=False,
-                message="No data found from either source. Please check your inputs and try again.",
-            )
-        
-        # -------------------------------------------------------
-        # 2.c Run Claude analysis & build comparison rows
-        # -------------------------------------------------------
-        notion_lookup = {r["parameter"].lower().strip(): r for r in notion_records if r.get("parameter")}
-        erp_lookup = {r["parameter"].lower().strip(): r for r in erp_records if r.get("parameter")}
-        
-        # Separate parameters into different categories
-        both_params = sorted(set(notion_lookup) & set(erp_lookup))  # Parameters in both systems
-        notion_only_params = sorted(set(notion_lookup) - set(erp_lookup))  # Only in Notion
-        erp_only_params = sorted(set(erp_lookup) - set(notion_lookup))  # Only in ERP
-        
-        logger.info(
-            "Parameter distribution: Notion=%d, ERP=%d, Both=%d, Notion-only=%d, ERP-only=%d",
-            len(notion_lookup),
-            len(erp_lookup),
-            len(both_params),
-            len(notion_only_params),
-            len(erp_only_params),
+        if cached:
+            update_progress("Fetching Notion data", 65, "Reusing Notion data fetched moments ago")
+        update_progress(
+            "Fetching Notion data",
+            65,
+            f"Retrieved {len(records)} Notion records",
         )
+        return records
+    except Exception as exc:
+        logger.warning("Notion fetch failed: %s", exc)
+        return []
 
+def _fetch_erp(prompt_name: Optional[str], force_refresh: bool = False) -> list[dict]:
+    """Fetch the ERP records, reporting progress; an empty list on failure."""
+    try:
+        update_progress("Fetching ERP data", 5, "Connecting to ERP system…")
+        records, cached = _cached_fetch(
+            ("erp", prompt_name), lambda failed: gather_erp_data(prompt_name, failed), force_refresh
+        )
+        if cached:
+            update_progress("Fetching ERP data", 80, "Reusing ERP data fetched moments ago")
         update_progress(
-            "AI Analysis with Claude", 82, f"Analyzing {len(both_params)} parameters with Claude…"
+            "Fetching ERP data",
+            80,
+            f"Retrieved {len(records)} ERP records",
         )
+        return records
+    except Exception as exc:
+        logger.warning("ERP fetch failed: %s", exc)
+        return []
 
-        import json
-        data_rows: list[list[str]] = []
-        section_headers: list[int] = []  # Track section header row indices
-        
-        def add_parameter_rows(param: str, notion_json: dict, erp_json: dict, comparison_text: str):
-            """Helper function to add parameter rows with proper formatting"""
-            from merge_compare import replace_logical_operators, has_uppercase_booleans, normalize_boolean_case
-            
-            # Apply logical operator replacements to Notion JSON before pretty-printing
-            processed_notion_json = replace_logical_operators(notion_json) if notion_json else notion_json
-
-            # Convert to pretty-printed JSON strings
-            notion_json_str = json.dumps(processed_notion_json, ensure_ascii=False, indent=2)
-            erp_json_str = json.dumps(erp_json, ensure_ascii=False, indent=2)
-            
-            # Check for uppercase booleans and normalize them
-            notion_has_uppercase = has_uppercase_booleans(notion_json_str)
-            erp_has_uppercase = has_uppercase_booleans(erp_json_str)
-            
-            # Normalize boolean case
-            notion_json_str = normalize_boolean_case(notion_json_str)
-            erp_json_str = normalize_boolean_case(erp_json_str)
-            
-            # Split large JSON strings to avoid 50k character limit
-            notion_chunks = split_large_text(notion_json_str)
-            erp_chunks = split_large_text(erp_json_str)
-            
-            # Determine how many rows we need (max of notion and erp chunks)
-            max_chunks = max(len(notion_chunks), len(erp_chunks))
-            
-            # Create rows - first row has parameter name and comparison, subsequent rows are continuations
-            for j in range(max_chunks):
-                if j == 0:
-                    # First row: include parameter name, comparison, and boolean error indicators
-                    row = [
-                        param,
-                        notion_chunks[j] if j < len(notion_chunks) else "",
-                        erp_chunks[j] if j < len(erp_chunks) else "",
-                        comparison_text,
-                        "🔴 Yes" if notion_has_uppercase and notion_chunks[j] else "🟢 No",  # Notion Boolean Error
-                        "🔴 Yes" if erp_has_uppercase and erp_chunks[j] else "🟢 No"        # ERP Boolean Error
-                    ]
-                else:
-                    # Continuation rows: empty parameter name and comparison, but keep boolean indicators
-                    row = [
-                        f"  └─ {param} (cont.)",  # Indented continuation indicator
-                        notion_chunks[j] if j < len(notion_chunks) else "",
-                        erp_chunks[j] if j < len(erp_chunks) else "",
-                        "",  # Empty comparison for continuation rows
-                        "🔴 Yes" if notion_has_uppercase and notion_chunks[j] else "🟢 No",  # Notion Boolean Error  
-                        "🔴 Yes" if erp_has_uppercase and erp_chunks[j] else "🟢 No"        # ERP Boolean Error
-                    ]
-                
-                data_rows.append(row)
-        
-        # 1. First: Parameters that exist in both sources (comparison)
-        for idx, param in enumerate(both_params):
-            n_json = notion_lookup[param]
-            e_json = erp_lookup[param]
-            
+def _serialize_side(record_json: dict) -> tuple[list[str], bool]:
+    """Render one side's JSON into sheet-cell chunks plus its uppercase-boolean flag."""
+    # Convert to pretty-printed JSON string
+    json_str = dumps_pretty(record_json)
+    
+    # Check for uppercase booleans and normalize them in one pass
+    json_str, has_uppercase = normalize_booleans(json_str)
+    
+    # Split large JSON strings to avoid 50k character limit
+    return split_large_text(json_str), has_uppercase
+
+# The missing side of Notion-only / ERP-only rows is always the same
+_EMPTY_SIDE = _serialize_side({})
+
+def _add_parameter_rows(job: ComparisonJob, param: str, notion_json: dict, erp_json: dict, comparison_text: str):
+    """Helper function to add parameter rows with proper formatting"""
+    data_rows = job.data_rows
+    # Apply logical operator replacements to Notion JSON before pretty-printing
+    notion_chunks, notion_has_uppercase = (
+        _serialize_side(replace_logical_operators(notion_json)) if notion_json else _EMPTY_SIDE
+    )
+    erp_chunks, erp_has_uppercase = _serialize_side(erp_json) if erp_json else _EMPTY_SIDE
+    
+    # Boolean error indicators, repeated on every row that has content for that side
+    notion_flag = "🔴 Yes" if notion_has_uppercase else "🟢 No"
+    erp_flag = "🔴 Yes" if erp_has_uppercase else "🟢 No"
+    
+    # Common case: both sides fit in one cell, so a single row
+    if len(notion_chunks) == 1 and len(erp_chunks) == 1:
+        data_rows.append([param, notion_chunks[0], erp_chunks[0], comparison_text, notion_flag, erp_flag])
+        return
+    
+    # First row has parameter name and comparison, subsequent rows are continuations
+    data_rows.append([param, notion_chunks[0], erp_chunks[0], comparison_text, notion_flag, erp_flag])
+    cont_label = f"  └─ {param} (cont.)"  # Indented continuation indicator
+    data_rows.extend(
+        [
+            cont_label,
+            notion_cell,
+            erp_cell,
+            "",  # Empty comparison for continuation rows
+            notion_flag if notion_cell else "🟢 No",  # Notion Boolean Error
+            erp_flag if erp_cell else "🟢 No",        # ERP Boolean Error
+        ]
+        for notion_cell, erp_cell in itertools.zip_longest(notion_chunks[1:], erp_chunks[1:], fillvalue="")
+    )
+
+# Row-building iterations between cancellation checks
+CANCEL_CHECK_EVERY = 32
+# Seconds between cancellation checks while waiting on Claude batches
+CANCEL_POLL_SECONDS = 0.5
+
+def _discard_unused_spreadsheet(future: concurrent.futures.Future) -> None:
+    """Done-callback for the early sheet setup of a run that was cancelled or failed."""
+    if future.exception() is None:
+        mc.discard_spreadsheet(future.result())
+
+def _cancel_job(spreadsheet_future: concurrent.futures.Future) -> ComparisonResponse:
+    """Record the cancellation and build the worker's response."""
+    update_progress("Cancelled", progress_data.get("progress_percentage", 0), "Validation cancelled by user")
+    set_progress_status("cancelled")
+    # Don't leave an empty shared sheet behind
+    spreadsheet_future.add_done_callback(_discard_unused_spreadsheet)
+    return ComparisonResponse(success=False, message="Validation cancelled by user")
+
+def _build_comparison_rows(job: ComparisonJob, notion_records: list[dict], erp_records: list[dict]) -> Optional[int]:
+    """Run the Claude analysis and fill ``job.data_rows`` / ``job.section_headers``.
+
+    Returns the number of parameters compared, or None if the run was cancelled.
+    """
+    # Single pass: key every record by its normalised parameter name into
+    # a [notion, erp] slot pair, so each name is lowered and hashed once
+    merged: dict[str, list] = {}
+    for r in notion_records:
+        if r.get("parameter"):
+            merged.setdefault(r["parameter"].lower().strip(), [None, None])[0] = r
+    for r in erp_records:
+        if r.get("parameter"):
+            merged.setdefault(r["parameter"].lower().strip(), [None, None])[1] = r
+    
+    # Separate parameters into different categories as (param, notion, erp)
+    both_params = []  # Parameters in both systems
+    notion_only_params = []  # Only in Notion
+    erp_only_params = []  # Only in ERP
+    for param, (n_json, e_json) in sorted(merged.items()):
+        if n_json is not None and e_json is not None:
+            both_params.append((param, n_json, e_json))
+        elif n_json is not None:
+            notion_only_params.append((param, n_json, e_json))
+        else:
+            erp_only_params.append((param, n_json, e_json))
+    
+    logger.info(
+        "Parameter distribution: Notion=%d, ERP=%d, Both=%d, Notion-only=%d, ERP-only=%d",
+        len(both_params) + len(notion_only_params),
+        len(both_params) + len(erp_only_params),
+        len(both_params),
+        len(notion_only_params),
+        len(erp_only_params),
+    )
+
+    update_progress(
+        "AI Analysis with Claude", 82, f"Analyzing {len(both_params)} parameters with Claude…"
+    )
+
+    data_rows = job.data_rows
+    section_headers = job.section_headers  # Track section header row indices
+
+    # 1. First: Parameters that exist in both sources (comparison)
+    # Parameters whose Notion and ERP logic are both identical get the
+    # same verdict, so Claude only sees one representative per group.
+    dedupe_groups: dict[bytes, list[int]] = {}
+    for idx, (_, n_json, e_json) in enumerate(both_params):
+        dedupe_groups.setdefault(mc.comparison_dedupe_key(n_json, e_json), []).append(idx)
+    unique_groups = list(dedupe_groups.values())
+    if len(unique_groups) < len(both_params):
+        logger.info("Deduplicated %d matched parameters into %d Claude comparisons",
+                    len(both_params), len(unique_groups))
+
+    # Claude calls are network-bound, so send the unique pairs in batches
+    # of CLAUDE_BATCH_SIZE per prompt and keep several batches in flight
+    # at once. Results are slotted back by index so the sheet order stays
+    # deterministic.
+    comparisons: list[str] = [""] * len(both_params)
+    batch_size = max(1, mc.CLAUDE_BATCH_SIZE)
+    batch_starts = range(0, len(unique_groups), batch_size)
+    if unique_groups:
+        max_workers = min(mc.CLAUDE_MAX_WORKERS, len(batch_starts))
+        # Not a with-block: on cancel the worker must return without joining
+        # the batches still in flight (they stop at their next cancel check)
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+        try:
             # Use Claude for comparison since both exist (with original complete data)
-            cmp_text = compare_with_claude(n_json, e_json)
+            futures = {
+                executor.submit(
+                    compare_batch_with_claude,
+                    [both_params[group[0]][1:] for group in unique_groups[start:start + batch_size]],
+                    job.cancel_event,
+                ): start
+                for start in batch_starts
+            }
+
+            done = 0
+            in_flight = set(futures)
+            while in_flight:
+                # Wake up periodically so a cancel is seen even while every batch is still running
+                finished, in_flight = concurrent.futures.wait(
+                    in_flight, timeout=CANCEL_POLL_SECONDS, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                if job.cancel_event.is_set():
+                    return None
+
+                for future in finished:
+                    start = futures[future]
+                    for group, cmp_text in zip(unique_groups[start:start + batch_size], future.result()):
+                        for idx in group:
+                            comparisons[idx] = cmp_text
+                        done += len(group)
+
+                if finished:
+                    pct = 82 + int((done / len(both_params)) * 4)  # 82-86%
+                    update_progress(
+                        "AI Analysis with Claude",
+                        pct,
+                        f"Analyzed {done}/{len(both_params)} matched parameters",
+                    )
+        finally:
+            # Drop every batch that hasn't started yet; after a full run there are none
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    # Every sheet row in order as (param, notion, erp, verdict), so one loop
+    # emits them all; a None verdict marks a section header row
+    plan = [(param, n_json, e_json, cmp_text)
+            for (param, n_json, e_json), cmp_text in zip(both_params, comparisons)]
+    # 2. Second: Notion-only parameters under their section header
+    if notion_only_params:
+        plan.append(("=== NOTION-ONLY PARAMETERS ===", None, None, None))
+        plan.extend((param, n_json, {}, "Parameter missing in ERP") for param, n_json, _ in notion_only_params)
+    # 3. Third: ERP-only parameters under their section header
+    if erp_only_params:
+        plan.append(("=== ERP-ONLY PARAMETERS ===", None, None, None))
+        plan.extend((param, {}, e_json, "Parameter missing in Notion") for param, _, e_json in erp_only_params)
+
+    update_progress("Building comparison rows", 86, f"Adding {len(plan)} rows…")
+    progress_due = _make_progress_throttle()
+    is_cancelled = job.cancel_event.is_set  # Bound once for the row loop
+    for idx, (param, n_json, e_json, cmp_text) in enumerate(plan):
+        if cmp_text is None:
+            section_headers.append(len(data_rows))  # Record the row index for formatting
+            data_rows.append([param, "", "", "", "", ""])
+        else:
+            _add_parameter_rows(job, param, n_json, e_json, cmp_text)
 
-            add_parameter_rows(param, n_json, e_json, cmp_text)
+        # Update progress (time-throttled; always report the last one)
+        if progress_due(final=idx + 1 == len(plan)):
+            progress = 86 + ((idx + 1) / len(plan)) * 4  # 86-90%
+            update_progress("Building comparison rows", int(progress), f"Processed {idx+1}/{len(plan)} rows")
 
-            if idx % 5 == 0:
-                pct = 82 + int((idx / len(both_params)) * 4)  # 82-86%
-                update_progress(
-                    "AI Analysis with Claude",
-                    pct,
-                    f"Analyzed {idx + 1}/{len(both_params)} matched parameters",
-                )
+        # Rows are cheap, so polling every CANCEL_CHECK_EVERY is responsive enough
+        if idx % CANCEL_CHECK_EVERY == 0 and is_cancelled():
+            return None
 
-            if cancel_event.is_set():
-                update_progress("Cancelled", progress_data.get("progress_percentage", 0), "Validation cancelled by user")
-                progress_data["status"] = "cancelled"
-                return ComparisonResponse(success=False, message="Validation cancelled by user")
-        
-        # 2. Second: Add section header for Notion-only parameters
-        if notion_only_params:
-            section_headers.append(len(data_rows))  # Record the row index for formatting
-            data_rows.append(["=== NOTION-ONLY PARAMETERS ===", "", "", "", "", ""])
-            
-            update_progress("Processing Notion-only parameters", 86, f"Adding {len(notion_only_params)} Notion-only parameters…")
-            for idx, param in enumerate(notion_only_params):
-                n_json = notion_lookup[param]
-                add_parameter_rows(param, n_json, {}, "Parameter missing in ERP")
-                
-                # Update progress
-                if idx % 5 == 0:
-                    progress = 86 + (idx / len(notion_only_params)) * 2  # 86-88%
-                    update_progress("Processing Notion-only parameters", int(progress), f"Processed {idx+1}/{len(notion_only_params)} Notion-only parameters")
-
-                if cancel_event.is_set():
-                    update_progress("Cancelled", progress_data.get("progress_percentage", 0), "Validation cancelled by user")
-                    progress_data["status"] = "cancelled"
-                    return ComparisonResponse(success=False, message="Validation cancelled by user")
-        
-        # 3. Third: Add section header for ERP-only parameters
-        if erp_only_params:
-            section_headers.append(len(data_rows))  # Record the row index for formatting
-            data_rows.append(["=== ERP-ONLY PARAMETERS ===", "", "", "", "", ""])
-            
-            update_progress("Processing ERP-only parameters", 88, f"Adding {len(erp_only_params)} ERP-only parameters…")
-            for idx, param in enumerate(erp_only_params):
-                e_json = erp_lookup[param]
-                add_parameter_rows(param, {}, e_json, "Parameter missing in Notion")
-                
-                # Update progress
-                if idx % 5 == 0:
-                    progress = 88 + (idx / len(erp_only_params)) * 2  # 88-90%
-                    update_progress("Processing ERP-only parameters", int(progress), f"Processed {idx+1}/{len(erp_only_params)} ERP-only parameters")
-
-                if cancel_event.is_set():
-                    update_progress("Cancelled", progress_data.get("progress_percentage", 0), "Validation cancelled by user")
-                    progress_data["status"] = "cancelled"
-                    return ComparisonResponse(success=False, message="Validation cancelled by user")
-
-        # -------------------------------------------------------
-        # 2.d Create Google Sheet with organized sections
-        # -------------------------------------------------------
-        update_progress("Generating comparison report", 90, "Analysis complete, preparing report…")
-        update_progress("Creating Google Sheet", 95, "Setting up Google Sheets…")
-
-        sheet_url = create_shared_google_sheet(data_rows, section_headers)
-        update_progress("Creating Google Sheet", 100, "Google Sheet created successfully!")
-        
-        elapsed = time.time() - start_time
-        progress_data["status"] = "completed"
-        
-        # Before returning, check cancellation once more
-        if cancel_event.is_set():
-            progress_data["status"] = "cancelled"
-            return ComparisonResponse(success=False, message="Validation cancelled by user")
+    return len(both_params)
+
+# ---------------------------------------------------------------
+# Blocking comparison worker (run in a thread by /api/compare)
+# ---------------------------------------------------------------
+def _perform_comparison(job: ComparisonJob) -> ComparisonResponse:
+    """Synchronous worker executed in a thread."""
 
+    logger.info("Starting comparison process…")
+    start_time = time.time()
+    
+    # Sources are passed to the fetchers explicitly instead of mutating
+    # merge_compare globals, so concurrent runs can't see each other's
+    database_url = f"https://www.notion.so/{extract_notion_id(job.page_id)}" if job.page_id else None
+    
+    # Register callback so helper functions can push granular updates
+    mc.set_progress_callback(update_progress)
+    mc.set_cancel_event(job.cancel_event)
+
+    # -------------------------------------------------------
+    # 1) Fetch Notion and ERP data
+    #     Both sources are independent network round-trips, so they are
+    #     fetched side by side and the phase takes max(t_notion, t_erp).
+    # -------------------------------------------------------
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+        notion_future = executor.submit(_fetch_notion, database_url, job.force_refresh) if job.page_id else None
+        erp_future = executor.submit(_fetch_erp, job.prompt_name, job.force_refresh) if job.prompt_name else None
+        notion_records: list[dict] = notion_future.result() if notion_future else []
+        erp_records: list[dict] = erp_future.result() if erp_future else []
+    
+    if not notion_records and not erp_records:
         return ComparisonResponse(
-            success=True,
-            message=f"Comparison completed successfully in {elapsed:.1f} seconds!",
-            sheet_url=sheet_url,
-            summary={
-                "notionRecords": len(notion_records),
-                "erpRecords": len(erp_records),
-                "totalComparisons": len(both_params),  # Only parameters that exist in both systems
-                "totalRows": len(data_rows),  # Total rows in the sheet
-                "processingTime": f"{elapsed:.1f}s",
-            },
+            success=False,
+            message="No data found from either source. Please check your inputs and try again.",
         )
-        
-    # ---------------------------------------------------------------
-    # 3. Off-load work to a background thread & await result
-    # ---------------------------------------------------------------
+    
+    # -------------------------------------------------------
+    # 2) Run Claude analysis & build comparison rows
+    # -------------------------------------------------------
+    # Creating, laying out and sharing the empty sheet needs none of the
+    # rows, so start it now and let those round-trips overlap the analysis
+    sheet_setup = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    spreadsheet_future = sheet_setup.submit(mc.create_spreadsheet)
+    sheet_setup.shutdown(wait=False)
+
     try:
-        response: ComparisonResponse = await asyncio.to_thread(
-            _perform_comparison, request.page_id, request.prompt_name
-        )
-        return response
+        compared = _build_comparison_rows(job, notion_records, erp_records)
+    except BaseException:
+        # A failed run must not leave the empty shared sheet behind either
+        spreadsheet_future.add_done_callback(_discard_unused_spreadsheet)
+        raise
+
+    # Last chance to stop before the (slow) sheet upload
+    if compared is None or job.cancel_event.is_set():
+        return _cancel_job(spreadsheet_future)
+
+    # -------------------------------------------------------
+    # 3) Create Google Sheet with organized sections
+    # -------------------------------------------------------
+    update_progress("Generating comparison report", 90, "Analysis complete, preparing report…")
+    update_progress("Creating Google Sheet", 95, "Setting up Google Sheets…")
+
+    try:
+        spreadsheet = spreadsheet_future.result()
+    except Exception as exc:
+        # Let the upload retry the setup (or fall back to Excel) itself
+        logger.warning("Early Google Sheet setup failed: %s", exc)
+        spreadsheet = None
+    sheet_url = create_shared_google_sheet(job.data_rows, job.section_headers, spreadsheet=spreadsheet)
+    update_progress("Creating Google Sheet", 100, "Google Sheet created successfully!")
+    
+    elapsed = time.time() - start_time
+    set_progress_status("completed")
+    
+    # Before returning, check cancellation once more
+    if job.cancel_event.is_set():
+        set_progress_status("cancelled")
+        return ComparisonResponse(success=False, message="Validation cancelled by user")
+
+    return ComparisonResponse(
+        success=True,
+        message=f"Comparison completed successfully in {elapsed:.1f} seconds!",
+        sheet_url=sheet_url,
+        summary={
+            "notionRecords": len(notion_records),
+            "erpRecords": len(erp_records),
+            "totalComparisons": compared,  # Only parameters that exist in both systems
+            "totalRows": len(job.data_rows),  # Total rows in the sheet
+            "processingTime": f"{elapsed:.1f}s",
+        },
+    )
+
+async def _run_job(job_id: str, job: ComparisonJob) -> None:
+    """Run one comparison off the event loop and store its result under *job_id*."""
+    try:
+        response: ComparisonResponse = await run_in_threadpool(_perform_comparison, job)
     except Exception as exc:
         logger.exception("Comparison failed: %s", exc)
-        return ComparisonResponse(success=False, message=f"Comparison failed: {exc}")
+        response = ComparisonResponse(success=False, message=f"Comparison failed: {exc}")
+    # Early returns (no data, failures) leave the status at "running"
+    if not response.success and progress_data.get("status") != "cancelled":
+        set_progress_status("error")
+    comparison_jobs[job_id].update(status="finished", result=response)
+    # This run's fetched records stay cached for FETCH_CACHE_TTL; free them
+    # afterwards even if no further run comes along to prune the cache
+    if FETCH_CACHE_TTL > 0:
+        asyncio.get_running_loop().call_later(FETCH_CACHE_TTL, _prune_fetch_cache)
+
+@app.post("/api/compare", status_code=202)
+async def compare_data(request: ComparisonRequest):
+    """Start the ERP-Notion comparison as a background job and return at once.
+
+    The heavy synchronous work is executed on Starlette's threadpool via
+    ``run_in_threadpool``; the response is ``202 Accepted`` with a ``job_id``
+    so the HTTP request doesn't stay open for minutes. Clients follow the run
+    through ``/api/progress`` (or its stream) and fetch the final
+    ``ComparisonResponse`` from ``/api/compare/{job_id}``.
+    """
+    
+    # ---------------------------------------------------------------
+    # 1. Validate request payload early – run on event-loop thread
+    # ---------------------------------------------------------------
+    if not request.page_id and not request.prompt_name:
+        raise HTTPException(
+            status_code=400, 
+            detail="At least one data source must be provided (page_id or prompt_name)",
+        )
+
+    # Progress and cancellation are process-wide, so only one run at a time
+    if any(job["status"] == "running" for job in comparison_jobs.values()):
+        raise HTTPException(status_code=409, detail="A validation is already running")
+
+    # ---------------------------------------------------------------
+    # 2. Off-load work to a background task & return the job id
+    # ---------------------------------------------------------------
+    # Reset + initialise progress before replying, so the client never sees
+    # the previous run's final state
+    reset_progress()
+    update_progress("Initializing validation process", 2, "Starting ECP validation…")
+
+    finished = [jid for jid, job in comparison_jobs.items() if job["status"] == "finished"]
+    for old_id in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+        del comparison_jobs[old_id]
+
+    job_id = uuid.uuid4().hex
+    job_cancel_event = threading.Event()
+    comparison_jobs[job_id] = {"status": "running", "result": None, "cancel_event": job_cancel_event}
+    task = asyncio.create_task(
+        _run_job(job_id, ComparisonJob(request.page_id, request.prompt_name, job_cancel_event, request.force_refresh))
+    )
+    _job_tasks.add(task)
+    task.add_done_callback(_job_tasks.discard)
+
+    return {"job_id": job_id, "status": "running", "result_url": f"/api/compare/{job_id}"}
+
+@app.get("/api/compare/{job_id}")
+async def get_comparison_result(job_id: str):
+    """Return the finished ``ComparisonResponse`` for *job_id* (202 while still running)."""
+    job = comparison_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown job id")
+    if job["status"] != "finished":
+        return ORJSONResponse(status_code=202, content={"job_id": job_id, "status": job["status"]})
+    return job["result"]
 
 @app.get("/health")
 async def health_check():
@@ -365,10 +731,55 @@ async def health_check():
     return {"status": "healthy", "timestamp": time.time()}
 
 @app.get("/api/progress")
-async def get_progress():
-    """Get current progress status"""
-    logger.debug(f"Progress requested: {progress_data}")
-    return progress_data
+async def get_progress(request: Request, since: int = 0, tail: int = 100):
+    """Get current progress status (up to ``tail`` log entries from index ``since`` onwards).
+
+    Polls whose ``If-None-Match`` carries the current ETag get an empty 304.
+    """
+    # Read before serialising: a change in between only makes the body newer
+    etag = get_progress_etag()
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return Response(content=get_progress_json(since, tail), media_type="application/json", headers=headers)
+
+@app.get("/api/progress/stream")
+async def stream_progress(request: Request, since: int = 0):
+    """Push progress updates as Server-Sent Events.
+
+    Each event carries only the log entries added since the previous event,
+    so the browser no longer has to poll and re-download the whole log.
+    """
+    changed = asyncio.Event()
+    subscriber = (asyncio.get_running_loop(), changed)
+
+    async def event_stream():
+        sent = since
+        last_state = None
+        with _progress_lock:
+            _progress_subscribers.add(subscriber)
+        try:
+            while not await request.is_disconnected():
+                changed.clear()
+                snapshot = get_progress_snapshot(sent)
+                state = (snapshot["current_step"], snapshot["progress_percentage"], snapshot["status"], snapshot["log_count"])
+                if state != last_state:
+                    last_state = state
+                    sent = snapshot["log_count"]
+                    yield f"data: {orjson.dumps(snapshot).decode()}\n\n"
+                try:
+                    await asyncio.wait_for(changed.wait(), timeout=15)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+        finally:
+            with _progress_lock:
+                _progress_subscribers.discard(subscriber)
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 @app.post("/api/reset-progress")
 async def reset_progress_endpoint():
@@ -383,7 +794,7 @@ async def test_progress():
     for i in range(0, 101, 10):
         update_progress("Testing progress", i, f"Test step {i}")
         await asyncio.sleep(0.1)
-    progress_data["status"] = "completed"
+    set_progress_status("completed")
     return {"message": "Progress test completed"}
 
 @app.post("/api/stop")
@@ -392,11 +803,24 @@ async def stop_validation():
     if progress_data.get("status") != "running":
         return {"message": "No validation in progress"}
 
-    cancel_event.set()
-    progress_data["status"] = "cancelled"
+    for job in comparison_jobs.values():
+        if job["status"] == "running":
+            job["cancel_event"].set()
+    set_progress_status("cancelled")
     update_progress("Cancelling", progress_data.get("progress_percentage", 0), "User requested cancellation")
     return {"message": "Cancellation signal sent"}
 
 if __name__ == "__main__":
+    import sys
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000) 
\ No newline at end of file
+    # uvloop + httptools (shipped with uvicorn[standard]) for lower per-request
+    # overhead; uvloop has no Windows build. Progress state lives in this
+    # process, so the server must stay at a single worker.
+    uvicorn.run(
+        app,
+        host="0.0.0.0",
+        port=8000,
+        loop="asyncio" if sys.platform == "win32" else "uvloop",
+        http="httptools",
+        workers=1,
+    ) 
\ No newline at end of file
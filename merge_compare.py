@@ -17,20 +17,26 @@ Install dependencies first:
 from __future__ import annotations
 
 import csv
+import hashlib
 import json
 import logging
 import os
+import random
+import re
+import shelve
 import sys
 import textwrap
 import threading
 import time
 import concurrent.futures
+from collections import OrderedDict
 from pathlib import Path
 from typing import Any, Dict, List, Optional
 
+import httpx
+import orjson
 import requests
 from dotenv import load_dotenv
-from openpyxl import Workbook
 from tqdm import tqdm
 from notion_client import Client
 from notion_client.errors import APIResponseError, RequestTimeoutError
@@ -102,6 +108,50 @@ DOMAIN_TO_SHARE = os.getenv("DOMAIN_TO_SHARE", "maids.cc")
 # ERP Configuration
 PAGE_SIZE = 100
 API_ROOT = "https://erpbackendpro.maids.cc/chatai/gptpromptparameter"
+# ERP records fetched concurrently after the ID listing
+ERP_FETCH_WORKERS = int(os.getenv("ERP_FETCH_WORKERS", "16"))
+# ID listing pages fetched concurrently once the first page reports totalPages
+ERP_PAGE_WORKERS = 8
+
+# Claude Configuration – number of comparisons kept in flight at once
+CLAUDE_MAX_WORKERS = int(os.getenv("CLAUDE_MAX_WORKERS", "10"))
+# Number of matched parameters sent to Claude in a single prompt
+CLAUDE_BATCH_SIZE = int(os.getenv("CLAUDE_BATCH_SIZE", "10"))
+# Number of Claude verdicts remembered between runs (0 disables the cache)
+CLAUDE_CACHE_SIZE = int(os.getenv("CLAUDE_CACHE_SIZE", "4096"))
+# Optional shelve file that keeps verdicts across restarts (empty disables)
+CLAUDE_CACHE_FILE = os.getenv("CLAUDE_CACHE_FILE", "")
+# Model used for every comparison
+CLAUDE_MODEL = "claude-3-sonnet-20240229"
+# Optional cheaper model asked first whether a pair is functionally identical;
+# only pairs it doesn't clear go to CLAUDE_MODEL (empty disables the triage)
+CLAUDE_TRIAGE_MODEL = os.getenv("CLAUDE_TRIAGE_MODEL", "")
+# Attempts per Claude request; rate limits, overload and 5xx are retried
+CLAUDE_MAX_ATTEMPTS = 3
+CLAUDE_RETRY_STATUSES = (429, 500, 502, 503, 504, 529)
+# CLI runs only: send matched pairs through the Message Batches API (about
+# half the cost, but results can take minutes to hours) instead of realtime calls
+CLAUDE_USE_BATCH_API = os.getenv("CLAUDE_USE_BATCH_API", "").lower() in ("1", "true", "yes")
+CLAUDE_BATCH_POLL_SECONDS = 30
+# Account limits for Claude requests / input tokens per minute (0 = unlimited)
+CLAUDE_RPM = float(os.getenv("CLAUDE_RPM", "0"))
+CLAUDE_TPM = float(os.getenv("CLAUDE_TPM", "0"))
+
+# Notion requests per second shared by all workers (Notion allows ~3 per
+# integration), and how many sibling blocks have their children fetched at once
+NOTION_RPS = float(os.getenv("NOTION_RPS", "3"))
+NOTION_CHILD_WORKERS = 3
+# Notion pages processed concurrently (their requests still share NOTION_RPS)
+NOTION_FETCH_WORKERS = int(os.getenv("NOTION_FETCH_WORKERS", "4"))
+# Optional shelve file keeping each page's extracted blocks, reused while the
+# page's last_edited_time is unchanged (empty disables)
+NOTION_CACHE_FILE = os.getenv("NOTION_CACHE_FILE", "")
+
+# Google Sheets upload – row batches written concurrently, each capped by
+# row count and approximate payload size to stay under API request limits
+SHEETS_UPLOAD_WORKERS = int(os.getenv("SHEETS_UPLOAD_WORKERS", "4"))
+SHEETS_BATCH_ROWS = 1000
+SHEETS_BATCH_BYTES = 4_000_000
 
 # Initialize global notion client variable for the helper functions
 notion = None
@@ -115,11 +165,127 @@ def set_progress_callback(callback):
     global progress_callback
     progress_callback = callback
 
+# Minimum seconds between per-item progress updates while the percentage is unchanged
+PROGRESS_MIN_INTERVAL = 0.25
+
+def _progress_reporter(step: str, base: int, span: int, total: int, message: str):
+    """Return ``report(done)`` forwarding per-item progress to ``progress_callback``.
+
+    *done* of *total* maps onto ``base``..``base + span`` percent and
+    *message* is formatted with ``done`` and ``total``. Updates are sent
+    only when the percentage moves, at most every PROGRESS_MIN_INTERVAL
+    seconds otherwise, and always for the last item – each one becomes a
+    log line in the web UI.
+    """
+    last = {"pct": None, "ts": 0.0}
+
+    def report(done: int) -> None:
+        if not progress_callback or not total:
+            return
+        pct = base + int(done / total * span)
+        now = time.monotonic()
+        if pct == last["pct"] and done < total and now - last["ts"] < PROGRESS_MIN_INTERVAL:
+            return
+        last["pct"], last["ts"] = pct, now
+        progress_callback(step, pct, message.format(done=done, total=total))
+
+    return report
+
 def set_cancel_event(event):
     """Register a threading.Event that signals cancellation."""
     global cancel_event
     cancel_event = event
 
+def new_http_session() -> requests.Session:
+    """Create a pooled session sized for the concurrent ERP/Claude workers."""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=max(10, CLAUDE_MAX_WORKERS, ERP_FETCH_WORKERS))
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+# Shared HTTP session – keeps TLS connections to the ERP and Anthropic hosts
+# alive between calls instead of handshaking per request. main.py swaps in
+# its own app-scoped session.
+http_session = new_http_session()
+
+def set_http_session(session: requests.Session):
+    """Use *session* for all outgoing ERP and Claude requests."""
+    global http_session
+    http_session = session
+
+class RateLimiter:
+    """Thread-safe token bucket over requests and tokens per minute.
+
+    ``acquire`` blocks until both buckets have room, so concurrent workers
+    are spread out before the API starts answering 429, and returns False
+    instead if the run is cancelled – the caller must then not send. A
+    rate of 0 turns that bucket off; ``pause`` holds every caller back
+    (e.g. on Retry-After). The request bucket holds a minute's worth unless
+    *request_capacity* caps the burst lower.
+    """
+
+    def __init__(self, requests_per_minute: float = 0, tokens_per_minute: float = 0,
+                 request_capacity: Optional[float] = None):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.request_capacity = float(requests_per_minute if request_capacity is None else max(1, request_capacity))
+        self._requests = self.request_capacity
+        self._tokens = float(tokens_per_minute)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _wait_time(self, tokens: int, now: float) -> float:
+        """Seconds until the call can go ahead, taking its share if it can now."""
+        elapsed, self._updated = now - self._updated, now
+        rpm, tpm = self.requests_per_minute, self.tokens_per_minute
+        if rpm:
+            self._requests = min(self.request_capacity, self._requests + elapsed * rpm / 60)
+        if tpm:
+            self._tokens = min(tpm, self._tokens + elapsed * tpm / 60)
+            tokens = min(tokens, tpm)  # A call bigger than the bucket still has to run eventually
+        if now < self._paused_until:
+            return self._paused_until - now
+
+        wait = 0.0
+        if rpm and self._requests < 1:
+            wait = (1 - self._requests) * 60 / rpm
+        if tpm and self._tokens < tokens:
+            wait = max(wait, (tokens - self._tokens) * 60 / tpm)
+        if wait == 0.0:
+            self._requests -= 1 if rpm else 0
+            self._tokens -= tokens if tpm else 0
+        return wait
+
+    def acquire(self, tokens: int = 0, cancel: Optional[threading.Event] = None) -> bool:
+        """Block until one request of about *tokens* tokens may be sent.
+
+        Returns False, without taking a share, once the run is cancelled
+        (*cancel*, else the registered ``cancel_event``).
+        """
+        cancel = cancel_event if cancel is None else cancel
+        while True:
+            if cancel is not None and cancel.is_set():
+                return False
+            with self._lock:
+                wait = self._wait_time(tokens, time.monotonic())
+            if wait <= 0:
+                return True
+            if cancel is not None:
+                cancel.wait(wait)
+            else:
+                time.sleep(wait)
+
+    def pause(self, seconds: float) -> None:
+        """Hold back every caller for *seconds*."""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+claude_limiter = RateLimiter(CLAUDE_RPM, CLAUDE_TPM)
+# Notion enforces ~NOTION_RPS per second, so allow only about a second of burst
+notion_limiter = RateLimiter(NOTION_RPS * 60, request_capacity=NOTION_RPS)
+
 # Set up logging for debugging
 log = logging.getLogger(__name__)
 log.setLevel(logging.WARNING)
@@ -162,58 +328,499 @@ COMPARISON_PROMPT = (
     "ERP JSON (Target):\n```json\n{{ERP_JSON}}\n```\n"
 )
 
+# Multi-pair variant: same rules, one verdict per item returned as JSON
+BATCH_COMPARISON_PROMPT = (
+    COMPARISON_PROMPT.partition("## COMPARISON TASK")[0]
+    + "## BATCH COMPARISON TASK\n"
+    "Each ITEM below is an independent pair of JSON configurations. Apply the RULES above to every item separately "
+    "and identify ONLY semantic differences that affect functionality.\n\n"
+    "Respond with ONLY a JSON array containing one object per item, in this exact shape:\n"
+    '[{"index": 0, "verdict": "<result for ITEM 0 following the RULES>"}, ...]\n\n'
+    "{{ITEMS}}"
+)
+
+# Triage variant: same criteria without the reply-format RULES (which ask
+# for a sentence or bullets), single-letter answer for CLAUDE_TRIAGE_MODEL
+TRIAGE_PROMPT = (
+    COMPARISON_PROMPT.partition("RULES:\n")[0]
+    + "## TRIAGE TASK\n"
+    "Apply the criteria above to the two JSON configurations below. Reply with exactly Y if they have no "
+    "functional differences, or exactly N otherwise. Do not explain.\n\n"
+    + COMPARISON_PROMPT.partition("## COMPARISON TASK\n")[2].partition("\n\n")[2]
+)
+
+# Templates split around their placeholders once, so building a prompt is a
+# single join rather than a str.replace scan over the template per call
+_PROMPT_HEAD, _, _prompt_rest = COMPARISON_PROMPT.partition("{{NOTION_JSON}}")
+_PROMPT_MIDDLE, _, _PROMPT_TAIL = _prompt_rest.partition("{{ERP_JSON}}")
+_BATCH_PROMPT_HEAD, _, _BATCH_PROMPT_TAIL = BATCH_COMPARISON_PROMPT.partition("{{ITEMS}}")
+_TRIAGE_HEAD, _, _triage_rest = TRIAGE_PROMPT.partition("{{NOTION_JSON}}")
+_TRIAGE_MIDDLE, _, _TRIAGE_TAIL = _triage_rest.partition("{{ERP_JSON}}")
+
 # ---------------------------------------------------------------------------
 # Helper – call Anthropic Claude
 # ---------------------------------------------------------------------------
 
-def compare_with_claude(notion_json: Dict[str, Any] | List[Any], erp_json: Dict[str, Any] | List[Any]) -> str:
-    """Return Claude comparison output (stripped)."""
-    # Final check to ensure 'extension.' is removed from both ERP and Notion JSON before comparison
-    cleaned_erp_json = _deep_replace_extension(erp_json)
-    if cleaned_erp_json != erp_json:
-        logging.debug("Final cleanup of 'extension.' in ERP JSON before comparison")
-    cleaned_notion_json = _deep_replace_extension(notion_json)
-    if cleaned_notion_json != notion_json:
-        logging.debug("Final cleanup of 'extension.' in Notion JSON before comparison")
+# LRU cache of Claude verdicts keyed by a digest of both configurations, so
+# re-validating unchanged parameters skips the API round-trip entirely.
+_claude_cache: OrderedDict[str, str] = OrderedDict()
+_claude_cache_lock = threading.Lock()
+
+def _canonical_json(obj: Any) -> bytes:
+    """Serialise *obj* with sorted keys and no whitespace (stable across runs)."""
+    return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS)
+
+# Verdict the prompt asks Claude to give when nothing functional differs
+NO_DIFFERENCES_VERDICT = "No significant functional differences found."
+# Placeholder for pairs left unanswered because the run was cancelled
+CANCELLED_VERDICT = "Comparison cancelled"
+
+def _logic_part(record: Any) -> Any:
+    """The part of a record Claude judges: ``conditionalLogic`` if present, else the whole record."""
+    if isinstance(record, dict) and "conditionalLogic" in record:
+        return record["conditionalLogic"]
+    return record
+
+def _normalised_logic(record: Any, drop_trivial_else: bool = False) -> Any:
+    """``_logic_part`` with the variations the prompt tells Claude to IGNORE removed.
+
+    Surrounding whitespace is stripped from every string and, for the ERP
+    side, trailing-style ``else`` entries whose value is empty or just ``.``
+    are dropped. Case and branch order are kept: parameter names are
+    compared strictly and conditions are evaluated in order.
+    """
+    logic = _logic_part(record)
+    if not isinstance(logic, list):
+        return logic
+    normalised = []
+    for entry in logic:
+        if isinstance(entry, dict):
+            entry = {k: v.strip() if isinstance(v, str) else v for k, v in entry.items()}
+            if drop_trivial_else and entry.get("condition") == "else" and entry.get("value", "") in ("", "."):
+                continue
+        normalised.append(entry)
+    return normalised
+
+def _has_identical_logic(notion_json: Any, erp_json: Any) -> bool:
+    """True when both sides carry the same conditional logic, so Claude can be skipped.
+
+    Records are compared on ``conditionalLogic`` only (identifiers always
+    differ between the two systems); anything else is compared whole.
+    """
+    return (_canonical_json(_normalised_logic(notion_json))
+            == _canonical_json(_normalised_logic(erp_json, drop_trivial_else=True)))
+
+def comparison_dedupe_key(notion_json: Any, erp_json: Any) -> bytes:
+    """Key under which pairs are guaranteed the same verdict.
+
+    The prompt tells Claude to ignore prompt/variable names, so parameters
+    whose Notion and ERP logic are both identical only need one comparison.
+    """
+    return _canonical_json(_logic_part(notion_json)) + b"||" + _canonical_json(_logic_part(erp_json))
+
+# Part of every cache key, so editing a prompt or the model invalidates
+# verdicts produced by the old one (matters once they persist on disk)
+_PROMPT_VERSION = hashlib.blake2b(
+    "|".join((CLAUDE_MODEL, COMPARISON_PROMPT, BATCH_COMPARISON_PROMPT, CLAUDE_TRIAGE_MODEL, TRIAGE_PROMPT)).encode("utf-8"),
+    digest_size=8
+).digest()
+
+def _comparison_cache_key(notion_bytes: bytes, erp_bytes: bytes) -> str:
+    """Cache key for a pair, from each side's ``_canonical_json`` serialisation."""
+    digest = hashlib.blake2b(_PROMPT_VERSION, digest_size=16)
+    digest.update(notion_bytes)
+    digest.update(b"|")
+    digest.update(erp_bytes)
+    return digest.hexdigest()
+
+_claude_disk_cache = None  # shelve.Shelf, opened on first use
+
+def _disk_cache() -> Optional[shelve.Shelf]:
+    """The persistent verdict store, or None when disabled or unusable (lock held)."""
+    global _claude_disk_cache, CLAUDE_CACHE_FILE
+    if _claude_disk_cache is None and CLAUDE_CACHE_FILE:
+        try:
+            _claude_disk_cache = shelve.open(CLAUDE_CACHE_FILE)
+        except Exception as e:
+            logging.warning("Could not open Claude cache file %s: %s", CLAUDE_CACHE_FILE, e)
+            CLAUDE_CACHE_FILE = ""  # Don't retry on every lookup
+    return _claude_disk_cache
+
+def _cache_get(key: str) -> Optional[str]:
+    with _claude_cache_lock:
+        result = _claude_cache.get(key)
+        if result is not None:
+            _claude_cache.move_to_end(key)
+            return result
+        disk = _disk_cache()
+        if disk is None:
+            return None
+        result = disk.get(key)
+    if result is not None:
+        _cache_put(key, result, persist=False)
+    return result
+
+def _cache_put(key: str, result: str, persist: bool = True) -> None:
+    with _claude_cache_lock:
+        if CLAUDE_CACHE_SIZE > 0:
+            _claude_cache[key] = result
+            _claude_cache.move_to_end(key)
+            while len(_claude_cache) > CLAUDE_CACHE_SIZE:
+                _claude_cache.popitem(last=False)
+        disk = _disk_cache() if persist else None
+        if disk is not None:
+            disk[key] = result
+            disk.sync()
+
+# Built once; every Claude call goes through the shared keep-alive session
+CLAUDE_HEADERS = {
+    "content-type": "application/json",
+    "x-api-key": ANTHROPIC_API_KEY,
+    "anthropic-version": "2023-06-01",
+}
+
+def _backoff_seconds(attempt: int) -> float:
+    """Exponential back-off with jitter for retry number *attempt*, capped at 30s."""
+    return min(2 ** attempt + random.uniform(0, 1), 30)
+
+def _wait_before_retry(delay: float, cancel: Optional[threading.Event] = None) -> bool:
+    """Sleep *delay* seconds; False if the run was cancelled meanwhile (don't retry).
 
-    prompt = (
-        COMPARISON_PROMPT.replace("{{NOTION_JSON}}", json.dumps(cleaned_notion_json, ensure_ascii=False, indent=2))
-        .replace("{{ERP_JSON}}", json.dumps(cleaned_erp_json, ensure_ascii=False, indent=2))
-    )
+    *cancel* defaults to the registered ``cancel_event``.
+    """
+    cancel = cancel_event if cancel is None else cancel
+    if cancel is not None:
+        return not cancel.wait(delay)
+    time.sleep(delay)
+    return True
+
+def _retry_after_seconds(resp: requests.Response, default: float = 1.0) -> float:
+    """Delay requested by a ``retry-after`` header (in seconds), else *default*."""
+    try:
+        return max(0.0, float(resp.headers.get("retry-after", default)))
+    except (TypeError, ValueError):
+        return default
 
+def _post_claude(prompt: str, max_tokens: int = 1024, model: Optional[str] = None,
+                 cancel: Optional[threading.Event] = None) -> tuple[bool, str]:
+    """Send *prompt* to the Messages API (``CLAUDE_MODEL`` unless *model* is given).
+
+    Returns ``(True, text)`` on success, otherwise ``(False, message)`` where
+    *message* is the short error string shown in the sheet. Nothing is sent
+    once *cancel* (default: the registered ``cancel_event``) is set.
+    """
     payload = {
-        "model": "claude-3-sonnet-20240229",
-        "max_tokens": 1024,
+        "model": model or CLAUDE_MODEL,
+        "max_tokens": max_tokens,
         "temperature": 0.1,
         "messages": [
             {"role": "user", "content": prompt}
         ],
     }
 
-    try:
-        resp = requests.post(
-            "https://api.anthropic.com/v1/messages",
-            headers={
-                "content-type": "application/json",
-                "x-api-key": ANTHROPIC_API_KEY,
-                "anthropic-version": "2023-06-01",
-            },
-            json=payload,
-            timeout=60,
-        )
+    body = orjson.dumps(payload)
+    for attempt in range(1, CLAUDE_MAX_ATTEMPTS + 1):
+        try:
+            # ~4 characters per token is close enough for budgeting input tokens
+            if not claude_limiter.acquire(len(prompt) // 4, cancel):
+                return False, CANCELLED_VERDICT
+            resp = http_session.post(
+                "https://api.anthropic.com/v1/messages",
+                headers=CLAUDE_HEADERS,
+                data=body,
+                timeout=(5, 55),  # Fail fast on connect, allow a long generation
+            )
+        except requests.RequestException as e:
+            logging.warning("Claude request failed on attempt %d/%d: %s", attempt, CLAUDE_MAX_ATTEMPTS, e)
+            if attempt < CLAUDE_MAX_ATTEMPTS and _wait_before_retry(_backoff_seconds(attempt), cancel):
+                continue
+            return False, f"Error calling Claude: {e}"
+        except Exception as e:
+            logging.error("Claude comparison failed: %s", e)
+            return False, f"Error calling Claude: {e}"
+
+        if resp.status_code in CLAUDE_RETRY_STATUSES and attempt < CLAUDE_MAX_ATTEMPTS:
+            delay = _retry_after_seconds(resp, _backoff_seconds(attempt))
+            logging.warning("Claude API error %s on attempt %d/%d – retrying in %.1fs",
+                            resp.status_code, attempt, CLAUDE_MAX_ATTEMPTS, delay)
+            if resp.status_code == 429:
+                # Let every worker back off for as long as the API asks
+                claude_limiter.pause(delay)
+            if _wait_before_retry(delay, cancel):
+                continue
         if resp.status_code != 200:
             logging.warning("Claude API error %s: %s", resp.status_code, resp.text[:200])
-            return f"API Error {resp.status_code}: {resp.text[:100]}"
-        data = resp.json()
+            return False, f"API Error {resp.status_code}: {resp.text[:100]}"
+
+        try:
+            data = orjson.loads(resp.content)
+        except ValueError as e:
+            logging.error("Claude comparison failed: %s", e)
+            return False, f"Error calling Claude: {e}"
         # Claude v1 format: top-level 'content' list with dicts containing 'text'
         if isinstance(data, dict):
             content = data.get("content")
             if isinstance(content, list) and content and isinstance(content[0], dict):
-                return content[0].get("text", "").strip()
-        return "[Unexpected Claude response]"
-    except Exception as e:
-        logging.error("Claude comparison failed: %s", e)
-        return f"Error calling Claude: {e}"
+                return True, content[0].get("text", "").strip()
+        return False, "[Unexpected Claude response]"
+    return False, "Error calling Claude: retries exhausted"
+
+def _clean_for_comparison(notion_json: Any, erp_json: Any) -> tuple[Any, Any]:
+    """Final check to ensure 'extension.' is removed from both sides before comparison."""
+    cleaned_erp_json = _deep_replace_extension(erp_json)
+    cleaned_notion_json = _deep_replace_extension(notion_json)
+    # The deep equality checks only feed debug logs, so skip them otherwise
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        if cleaned_erp_json != erp_json:
+            logging.debug("Final cleanup of 'extension.' in ERP JSON before comparison")
+        if cleaned_notion_json != notion_json:
+            logging.debug("Final cleanup of 'extension.' in Notion JSON before comparison")
+    return cleaned_notion_json, cleaned_erp_json
+
+def _prepare_pair(notion_json: Any, erp_json: Any) -> tuple[Optional[str], str, bytes, bytes]:
+    """Clean a pair and serialise each side once.
+
+    Returns ``(verdict, cache_key, notion_bytes, erp_bytes)``; *verdict* is
+    set when no Claude call is needed (identical logic or a cached result).
+    The canonical bytes feed both the cache key and the prompt – compact
+    JSON only saves input tokens, and the prompt already tells Claude to
+    ignore formatting and key order.
+    """
+    cleaned_notion_json, cleaned_erp_json = _clean_for_comparison(notion_json, erp_json)
+    if _has_identical_logic(cleaned_notion_json, cleaned_erp_json):
+        return NO_DIFFERENCES_VERDICT, "", b"", b""
+    notion_bytes, erp_bytes = _canonical_json(cleaned_notion_json), _canonical_json(cleaned_erp_json)
+    cache_key = _comparison_cache_key(notion_bytes, erp_bytes)
+    return _cache_get(cache_key), cache_key, notion_bytes, erp_bytes
+
+def _comparison_prompt(notion_bytes: bytes, erp_bytes: bytes) -> str:
+    """Single-pair comparison prompt for a prepared pair."""
+    return "".join((_PROMPT_HEAD, notion_bytes.decode("utf-8"), _PROMPT_MIDDLE, erp_bytes.decode("utf-8"), _PROMPT_TAIL))
+
+def _triage_clears(notion_bytes: bytes, erp_bytes: bytes, cache_key: str,
+                   cancel: Optional[threading.Event] = None) -> bool:
+    """Ask ``CLAUDE_TRIAGE_MODEL`` whether a prepared pair is functionally identical.
+
+    Only a clean "Y" counts – errors and anything else escalate to the full
+    comparison. Cleared pairs are cached with the no-differences verdict.
+    """
+    prompt = "".join((_TRIAGE_HEAD, notion_bytes.decode("utf-8"), _TRIAGE_MIDDLE, erp_bytes.decode("utf-8"), _TRIAGE_TAIL))
+    ok, answer = _post_claude(prompt, max_tokens=5, model=CLAUDE_TRIAGE_MODEL, cancel=cancel)
+    if ok and answer.upper().rstrip(".") == "Y":
+        _cache_put(cache_key, NO_DIFFERENCES_VERDICT)
+        return True
+    return False
+
+def _compare_prepared(notion_bytes: bytes, erp_bytes: bytes, cache_key: str,
+                      cancel: Optional[threading.Event] = None) -> str:
+    """Call Claude for a prepared, cache-missed pair and cache the verdict."""
+    ok, result = _post_claude(_comparison_prompt(notion_bytes, erp_bytes), cancel=cancel)
+    if ok:
+        _cache_put(cache_key, result)
+    return result
+
+def compare_with_claude(notion_json: Dict[str, Any] | List[Any], erp_json: Dict[str, Any] | List[Any],
+                        cancel: Optional[threading.Event] = None) -> str:
+    """Return Claude comparison output (stripped).
+
+    Pairs whose conditional logic is identical skip the API call. Successful
+    verdicts are cached by the canonical content of both inputs; API errors
+    are never cached so they are retried on the next run. *cancel* defaults
+    to the registered ``cancel_event``.
+    """
+    verdict, cache_key, notion_bytes, erp_bytes = _prepare_pair(notion_json, erp_json)
+    if verdict is not None:
+        return verdict
+    if CLAUDE_TRIAGE_MODEL and _triage_clears(notion_bytes, erp_bytes, cache_key, cancel):
+        logging.debug("Triage cleared %s", cache_key)
+        return NO_DIFFERENCES_VERDICT
+    return _compare_prepared(notion_bytes, erp_bytes, cache_key, cancel)
+
+def _parse_batch_verdicts(text: str, count: int) -> Dict[int, str]:
+    """Extract ``{index: verdict}`` from a batch reply; malformed entries are skipped."""
+    start, end = text.find("["), text.rfind("]")
+    if start == -1 or end <= start:
+        return {}
+    try:
+        items = orjson.loads(text[start:end + 1])
+    except orjson.JSONDecodeError:
+        return {}
+
+    verdicts: Dict[int, str] = {}
+    if isinstance(items, list):
+        for item in items:
+            if not isinstance(item, dict):
+                continue
+            index, verdict = item.get("index"), item.get("verdict")
+            if isinstance(index, int) and 0 <= index < count and isinstance(verdict, str):
+                verdicts[index] = verdict.strip()
+    return verdicts
+
+def compare_batch_with_claude(pairs: List[tuple[Any, Any]], cancel: Optional[threading.Event] = None) -> List[str]:
+    """Compare several (notion_json, erp_json) pairs with a single Claude call.
+
+    Pairs with identical logic and cached pairs are answered locally; the
+    rest are sent together in one prompt asking for a JSON array of
+    verdicts. Any pair the reply does not cover (API error, unparsable
+    output) is retried on its own, reusing its already cleaned inputs.
+    Once the run is cancelled no further calls are made and unanswered
+    pairs get ``CANCELLED_VERDICT``. Pass the run's own *cancel* event when
+    this batch may outlive the run: the registered ``cancel_event`` is
+    replaced by the next run's.
+    """
+    cancel = cancel_event if cancel is None else cancel
+    if len(pairs) == 1:
+        return [compare_with_claude(*pairs[0], cancel=cancel)]
+
+    results: List[Optional[str]] = [None] * len(pairs)
+    pending: List[tuple[int, str, bytes, bytes]] = []  # (index, cache key, notion bytes, erp bytes)
+    for i, (notion_json, erp_json) in enumerate(pairs):
+        verdict, cache_key, notion_bytes, erp_bytes = _prepare_pair(notion_json, erp_json)
+        if verdict is not None:
+            results[i] = verdict
+        else:
+            pending.append((i, cache_key, notion_bytes, erp_bytes))
+    if len(pending) < len(pairs):
+        logging.info("%d of %d pairs answered without Claude (identical logic or cached)",
+                     len(pairs) - len(pending), len(pairs))
+
+    if CLAUDE_TRIAGE_MODEL and pending:
+        # One call at a time: batches already run CLAUDE_MAX_WORKERS wide,
+        # and triage replies are a single token
+        cleared = [_triage_clears(notion_bytes, erp_bytes, cache_key, cancel)
+                   for _, cache_key, notion_bytes, erp_bytes in pending]
+        escalated = [item for item, ok in zip(pending, cleared) if not ok]
+        for (i, _, _, _), ok in zip(pending, cleared):
+            if ok:
+                results[i] = NO_DIFFERENCES_VERDICT
+        logging.info("Triage escalated %d of %d pairs to %s", len(escalated), len(pending), CLAUDE_MODEL)
+        pending = escalated
+
+    if cancel is not None and cancel.is_set():
+        return [CANCELLED_VERDICT if r is None else r for r in results]
+
+    if len(pending) > 1:
+        items = "".join(
+            f"### ITEM {n}\n"
+            f"NOTION JSON (Reference):\n```json\n{notion_bytes.decode('utf-8')}\n```\n\n"
+            f"ERP JSON (Target):\n```json\n{erp_bytes.decode('utf-8')}\n```\n\n"
+            for n, (_, _, notion_bytes, erp_bytes) in enumerate(pending)
+        )
+        prompt = "".join((_BATCH_PROMPT_HEAD, items, _BATCH_PROMPT_TAIL))
+        ok, text = _post_claude(prompt, max_tokens=min(4096, 512 * len(pending)), cancel=cancel)
+        verdicts = _parse_batch_verdicts(text, len(pending)) if ok else {}
+        if ok and len(verdicts) < len(pending):
+            logging.warning("Claude batch reply covered %d/%d items – retrying the rest individually",
+                            len(verdicts), len(pending))
+        for n, (i, cache_key, _, _) in enumerate(pending):
+            if n in verdicts:
+                results[i] = verdicts[n]
+                _cache_put(cache_key, verdicts[n])
+
+    # Reuse the serialised sides and keys from above rather than preparing again
+    for i, cache_key, notion_bytes, erp_bytes in pending:
+        if results[i] is not None:
+            continue
+        if cancel is not None and cancel.is_set():
+            return [CANCELLED_VERDICT if r is None else r for r in results]
+        results[i] = _compare_prepared(notion_bytes, erp_bytes, cache_key, cancel)
+    return results
+
+def _run_message_batch(prompts: Dict[str, str], max_tokens: int = 1024) -> Dict[str, str]:
+    """Submit *prompts* (``{custom_id: prompt}``) as one Message Batch and wait for it.
+
+    Returns ``{custom_id: text}`` for the requests that succeeded. The batch
+    is cancelled if the run is, leaving whatever already finished.
+    """
+    base = "https://api.anthropic.com/v1/messages/batches"
+    body = {
+        "requests": [
+            {
+                "custom_id": custom_id,
+                "params": {
+                    "model": CLAUDE_MODEL,
+                    "max_tokens": max_tokens,
+                    "temperature": 0.1,
+                    "messages": [{"role": "user", "content": prompt}],
+                },
+            }
+            for custom_id, prompt in prompts.items()
+        ]
+    }
+    resp = http_session.post(base, headers=CLAUDE_HEADERS, data=orjson.dumps(body), timeout=120)
+    resp.raise_for_status()
+    batch = orjson.loads(resp.content)
+    logging.info("Submitted Claude message batch %s with %d requests", batch["id"], len(prompts))
+
+    while batch.get("processing_status") != "ended":
+        if cancel_event is not None and cancel_event.wait(CLAUDE_BATCH_POLL_SECONDS):
+            http_session.post(f"{base}/{batch['id']}/cancel", headers=CLAUDE_HEADERS, timeout=30)
+            logging.info("Cancelled Claude message batch %s", batch["id"])
+            return {}
+        if cancel_event is None:
+            time.sleep(CLAUDE_BATCH_POLL_SECONDS)
+        resp = http_session.get(f"{base}/{batch['id']}", headers=CLAUDE_HEADERS, timeout=30)
+        resp.raise_for_status()
+        batch = orjson.loads(resp.content)
+        logging.info("Claude message batch %s: %s", batch["id"], batch.get("request_counts"))
+
+    # Results are JSON Lines, one object per request in any order
+    resp = http_session.get(batch["results_url"], headers=CLAUDE_HEADERS, timeout=120)
+    resp.raise_for_status()
+    texts: Dict[str, str] = {}
+    for line in resp.content.splitlines():
+        if not line.strip():
+            continue
+        item = orjson.loads(line)
+        result = item.get("result") or {}
+        if result.get("type") != "succeeded":
+            logging.warning("Claude batch request %s: %s", item.get("custom_id"), result.get("type"))
+            continue
+        content = result.get("message", {}).get("content")
+        if isinstance(content, list) and content and isinstance(content[0], dict):
+            texts[item["custom_id"]] = content[0].get("text", "").strip()
+    return texts
+
+def compare_pairs_with_batch_api(pairs: List[tuple[Any, Any]]) -> List[str]:
+    """Compare (notion_json, erp_json) pairs through the Message Batches API.
+
+    Same verdicts as ``compare_with_claude`` (identical and cached pairs are
+    answered locally, successes are cached), but all remaining pairs go out
+    in one batch – once per distinct pair, since duplicates share a cache
+    key. Pairs the batch doesn't answer are retried in realtime.
+    """
+    results: List[Optional[str]] = [None] * len(pairs)
+    # custom_id -> (indices sharing the pair, cache key, notion bytes, erp bytes)
+    pending: Dict[str, tuple[List[int], str, bytes, bytes]] = {}
+    custom_ids: Dict[str, str] = {}  # cache key -> custom_id
+    for i, (notion_json, erp_json) in enumerate(pairs):
+        verdict, cache_key, notion_bytes, erp_bytes = _prepare_pair(notion_json, erp_json)
+        if verdict is not None:
+            results[i] = verdict
+        elif cache_key in custom_ids:
+            pending[custom_ids[cache_key]][0].append(i)
+        else:
+            custom_ids[cache_key] = f"pair-{i}"
+            pending[f"pair-{i}"] = ([i], cache_key, notion_bytes, erp_bytes)
+
+    if pending:
+        try:
+            texts = _run_message_batch({
+                custom_id: _comparison_prompt(notion_bytes, erp_bytes)
+                for custom_id, (_, _, notion_bytes, erp_bytes) in pending.items()
+            })
+        except (requests.RequestException, KeyError, ValueError) as e:
+            logging.warning("Claude message batch failed, comparing in realtime instead: %s", e)
+            texts = {}
+        for custom_id, (indices, cache_key, notion_bytes, erp_bytes) in pending.items():
+            if custom_id in texts:
+                verdict = texts[custom_id]
+                _cache_put(cache_key, verdict)
+            else:
+                verdict = _compare_prepared(notion_bytes, erp_bytes, cache_key)
+            for i in indices:
+                results[i] = verdict
+    return results
 
 # ---------------------------------------------------------------------------
 # ERP FETCH HELPERS (copied from erpfetch.py)
@@ -288,19 +895,30 @@ def _normalise_op(op: str) -> str:
     op = op.upper()
     return {"=": "==", "IS NULL": "IS NULL", "IS NOT NULL": "IS NOT NULL"}.get(op, op)
 
+def _leaf_to_string(node: Dict[str, Any]) -> str:
+    field = node.get("fieldName", "")
+    if field and field.startswith("$context."):
+        field = field[len("$context."):]
+    field = FIELD_RENAMES.get(field, field)
+    op = _normalise_op(node.get("operation", ""))
+    val = node.get("value")
+    return f"{field} {op}" if op.startswith("IS") else f"{field} {op} {val}"
+
 def _expr_to_string(node: Dict[str, Any]) -> str:
-    if node.get("leaf", False) or not ("left" in node and "right" in node):
-        field = node.get("fieldName", "")
-        if field and field.startswith("$context."):
-            field = field[len("$context."):]
-        field = FIELD_RENAMES.get(field, field)
-        op = _normalise_op(node.get("operation", ""))
-        val = node.get("value")
-        return f"{field} {op}" if op.startswith("IS") else f"{field} {op} {val}"
-    left = _expr_to_string(node["left"])
-    right = _expr_to_string(node["right"])
-    logic = node.get("logicalOperator", "").upper()
-    return f"( {left} {logic} {right} )"
+    # Walks the tree with an explicit stack and joins the tokens once, instead
+    # of recursing and re-copying every nested sub-expression string per level
+    parts: List[str] = []
+    stack: List[Any] = [node]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, str):
+            parts.append(item)
+        elif item.get("leaf", False) or not ("left" in item and "right" in item):
+            parts.append(_leaf_to_string(item))
+        else:
+            logic = item.get("logicalOperator", "").upper()
+            stack.extend((")", item["right"], logic, item["left"], "("))
+    return " ".join(parts)
 
 def _deep_replace_extension(obj: Any) -> Any:
     """Recursively replace 'extension.' in all strings within a nested structure."""
@@ -367,47 +985,75 @@ def convert_record(raw: Dict[str, Any]) -> Dict[str, Any]:
         "conditionalLogic": logic,
     }
 
-def fetch_ids() -> List[int]:
-    """Fetch all GPTPromptParameter IDs, filtering out CONTEXT evaluation types."""
+def _fetch_id_page(page: int, headers: Dict[str, str]) -> tuple[List[int], Optional[int], bool]:
+    """Fetch one ``/page/`` listing.
+
+    Returns ``(ids, total_pages, is_last)`` where *ids* excludes CONTEXT
+    evaluation types and *total_pages* is ``None`` when the API omits it.
+    """
+    params = {"page": page, "size": PAGE_SIZE, "sort": "creationDate,DESC", "search": ""}
+    resp = http_session.get(f"{API_ROOT}/page/", headers=headers, params=params, timeout=30)
+    logging.info("/page/ %s → %s", page, resp.status_code)
+
+    if resp.status_code in (401, 403):
+        raise ValueError("ERP Auth token expired. Please update your .env file.")
+
+    resp.raise_for_status()
+    body = orjson.loads(resp.content)
+    chunk = body.get("content", [])
+
+    filtered_chunk = [item for item in chunk if item.get("evaluationType") != "CONTEXT"]
+    logging.info("Page %s: %s total records, %s after filtering out CONTEXT types",
+                page, len(chunk), len(filtered_chunk))
+
+    total_pages = body.get("totalPages")
+    return [item["id"] for item in filtered_chunk], total_pages if isinstance(total_pages, int) else None, len(chunk) < PAGE_SIZE
+
+def fetch_ids(prompt_name: Optional[str] = None, failed: Optional[List[Any]] = None) -> List[int]:
+    """Fetch all GPTPromptParameter IDs, filtering out CONTEXT evaluation types.
+
+    The first page is fetched on its own; when it reports ``totalPages`` the
+    remaining pages are requested concurrently, otherwise pages are walked
+    one at a time until a short page.
+
+    *prompt_name* defaults to the module-level ``PROMPT_NAME``. If a page
+    fails the IDs found so far are returned and the page number is appended
+    to *failed*, if given.
+    """
+    prompt_name = prompt_name or PROMPT_NAME
     ids: List[int] = []
+    # Header depends only on the prompt name, so build it once for all pages
+    headers = {
+        **PAGE_HEADERS,
+        "searchfilter": get_search_filter_header_value(prompt_name)
+    }
+
     page = 0
-    
-    while True:
-        params = {"page": page, "size": PAGE_SIZE, "sort": "creationDate,DESC", "search": ""}
-        headers = {
-            **PAGE_HEADERS,
-            "searchfilter": get_search_filter_header_value(PROMPT_NAME)
-        }
-        
-        try:
-            resp = requests.get(f"{API_ROOT}/page/", headers=headers, params=params, timeout=30)
-            logging.info("/page/ %s → %s", page, resp.status_code)
-            
-            if resp.status_code in (401, 403):
-                raise ValueError("ERP Auth token expired. Please update your .env file.")
-            
-            resp.raise_for_status()
-            chunk = resp.json().get("content", [])
-            
-            if not chunk:
-                break
-            
-            filtered_chunk = [item for item in chunk if item.get("evaluationType") != "CONTEXT"]
-            logging.info("Page %s: %s total records, %s after filtering out CONTEXT types", 
-                        page, len(chunk), len(filtered_chunk))
-            
-            ids.extend(item["id"] for item in filtered_chunk)
-            
-            if len(chunk) < PAGE_SIZE:
-                break
-            page += 1
-            
-        except Exception as err:
-            logging.error("Error fetching page %s: %s", page, err)
-            if "ERP Auth token expired" in str(err):
-                raise
-            break
-    
+    try:
+        page_ids, total_pages, is_last = _fetch_id_page(page, headers)
+        ids.extend(page_ids)
+
+        if not is_last and total_pages is not None and total_pages > 1:
+            max_workers = min(ERP_PAGE_WORKERS, total_pages - 1)
+            with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+                futures = [executor.submit(_fetch_id_page, p, headers) for p in range(1, total_pages)]
+                # Keep page order; like the sequential walk, stop at the first failed page
+                for page, future in enumerate(futures, start=1):
+                    page_ids, _, _ = future.result()
+                    ids.extend(page_ids)
+        else:
+            while not is_last:
+                page += 1
+                page_ids, _, is_last = _fetch_id_page(page, headers)
+                ids.extend(page_ids)
+
+    except Exception as err:
+        logging.error("Error fetching page %s: %s", page, err)
+        if "ERP Auth token expired" in str(err):
+            raise
+        if failed is not None:
+            failed.append(page)
+
     logging.info("Discovered %d IDs", len(ids))
     return ids
 
@@ -416,8 +1062,11 @@ def fetch_one(ident: int) -> Dict[str, Any]:
     max_attempts = 3
     backoff = 1
     for attempt in range(1, max_attempts + 1):
+        # Queued workers bail out instead of issuing requests for a cancelled run
+        if cancel_event is not None and cancel_event.is_set():
+            raise RuntimeError("ERP fetch cancelled")
         try:
-            resp = requests.get(f"{API_ROOT}/{ident}", headers=DETAIL_HEADERS, timeout=30)
+            resp = http_session.get(f"{API_ROOT}/{ident}", headers=DETAIL_HEADERS, timeout=30)
             logging.info("GET %s → %s (attempt %d)", ident, resp.status_code, attempt)
     
             # Auth failures should abort immediately
@@ -425,7 +1074,7 @@ def fetch_one(ident: int) -> Dict[str, Any]:
                 raise ValueError("ERP Auth token expired. Please update your .env file.")
     
             if resp.status_code == 200:
-                return resp.json()
+                return orjson.loads(resp.content)
 
             # For transient 5xx errors – retry
             if 500 <= resp.status_code < 600:
@@ -437,9 +1086,8 @@ def fetch_one(ident: int) -> Dict[str, Any]:
             break
         except Exception as exc:
             logging.warning("fetch_one id=%s failed on attempt %d/%d: %s", ident, attempt, max_attempts, exc)
-            if attempt == max_attempts:
+            if attempt == max_attempts or not _wait_before_retry(backoff):
                 raise
-            time.sleep(backoff)
             backoff *= 2  # exponential back-off
 
     # If we reach here all retries failed
@@ -449,8 +1097,12 @@ def fetch_one(ident: int) -> Dict[str, Any]:
 # NOTION HELPERS (copied from kareemdatabasetest.py)
 # ---------------------------------------------------------------------------
 
-def _fetch_all_children(block_id: str) -> List[dict]:
-    """Return every child block, or [] if the API refuses (400/404/403)."""
+def _fetch_all_children(block_id: str, failed: Optional[List[str]] = None) -> List[dict]:
+    """Return every child block, or [] if the API refuses (400/404/403).
+
+    When retries run out (timeouts, rate limits) the children fetched so far
+    are returned and *block_id* is appended to *failed*, if given.
+    """
     log.debug("Fetching children for block: %s", block_id[:8] + "...")
     children, cursor = [], None
     page_count = 0
@@ -462,6 +1114,11 @@ def _fetch_all_children(block_id: str) -> List[dict]:
             try:
                 page_count += 1
                 log.debug("Fetching page %d of children for block %s...", page_count, block_id[:8] + "...")
+                if not notion_limiter.acquire():
+                    # Cancelled: what was fetched so far is incomplete
+                    if failed is not None:
+                        failed.append(block_id)
+                    return children
                 resp = notion.blocks.children.list(
                     block_id, start_cursor=cursor, page_size=100
                 )
@@ -477,6 +1134,8 @@ def _fetch_all_children(block_id: str) -> List[dict]:
                     continue
                 else:
                     log.error("Repeated timeouts when fetching children for block %s – giving up", block_id[:8] + "...")
+                    if failed is not None:
+                        failed.append(block_id)
                     return children
                     
             except APIResponseError as e:
@@ -493,11 +1152,15 @@ def _fetch_all_children(block_id: str) -> List[dict]:
                         wait_time = base_wait + jitter
                         log.warning("Rate limited when fetching children for block %s – retrying (%d/%d) in %.1fs", 
                                   block_id[:8] + "...", retry_count, max_retries, wait_time)
+                        # Back off every worker, not just this one
+                        notion_limiter.pause(wait_time)
                         time.sleep(wait_time)
                         continue
                     else:
                         log.error("Rate limit exceeded for block %s after %d retries – giving up", 
                                 block_id[:8] + "...", max_retries)
+                        if failed is not None:
+                            failed.append(block_id)
                         return children
                 
                 # Handle other errors (403, 404, etc.) - don't retry these
@@ -512,6 +1175,8 @@ def _fetch_all_children(block_id: str) -> List[dict]:
         else:
             # If we exhausted all retries without success
             log.error("Failed to fetch children for block %s after %d retries", block_id[:8] + "...", max_retries)
+            if failed is not None:
+                failed.append(block_id)
             return children
 
         children.extend(resp["results"])
@@ -526,6 +1191,25 @@ def _fetch_all_children(block_id: str) -> List[dict]:
     log.info("Retrieved %d total children for block %s", len(children), block_id[:8] + "...")
     return children
 
+def _fetch_children_tree(root_id: str, failed: Optional[List[str]] = None) -> Dict[str, List[dict]]:
+    """Fetch the children of *root_id* and all its descendants, keyed by parent id.
+
+    The tree is walked one level at a time so sibling subtrees are fetched
+    concurrently; ``notion_limiter`` keeps the combined rate within limits.
+    """
+    tree: Dict[str, List[dict]] = {}
+    frontier = [root_id]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=NOTION_CHILD_WORKERS) as executor:
+        while frontier:
+            if cancel_event and cancel_event.is_set():
+                break
+            next_frontier = []
+            for bid, children in zip(frontier, executor.map(lambda bid: _fetch_all_children(bid, failed), frontier)):
+                tree[bid] = children
+                next_frontier.extend(child["id"] for child in children if child.get("has_children"))
+            frontier = next_frontier
+    return tree
+
 def _plain_text(block: dict) -> str:
     """Concatenate rich-text → plain string.
     
@@ -605,11 +1289,29 @@ def _extract_block_content(block: dict, notion_client=None) -> Dict[str, Any]:
     
     return content
 
+_notion_disk_cache = None  # shelve.Shelf, opened on first use
+_notion_cache_lock = threading.Lock()
+
+def _notion_block_cache() -> Optional[shelve.Shelf]:
+    """The persistent page-block store, or None when disabled or unusable."""
+    global _notion_disk_cache, NOTION_CACHE_FILE
+    if _notion_disk_cache is None and NOTION_CACHE_FILE:
+        try:
+            _notion_disk_cache = shelve.open(NOTION_CACHE_FILE)
+        except Exception as e:
+            logging.warning("Could not open Notion cache file %s: %s", NOTION_CACHE_FILE, e)
+            NOTION_CACHE_FILE = ""  # Don't retry on every page
+    return _notion_disk_cache
+
+# One httpx connection pool behind every Notion Client instance, so each run
+# (and each page's block fetches) reuses the open TLS connections to api.notion.com
+_notion_http_client = httpx.Client()
+
 class NotionDatabaseToCSV:
     def __init__(self, api_key: str):
         """Initialize the Notion client with API key"""
         global notion
-        self.notion = Client(auth=api_key)
+        self.notion = Client(auth=api_key, client=_notion_http_client)
         notion = self.notion
     
     def extract_database_id_from_url(self, database_url: str) -> str:
@@ -626,60 +1328,56 @@ class NotionDatabaseToCSV:
         
         raise ValueError("Invalid Notion database URL format")
 
-    def extract_all_blocks_using_working_algorithm(self, page_id: str) -> List[Dict[str, Any]]:
+    def extract_all_blocks_using_working_algorithm(self, page_id: str, failed: Optional[List[str]] = None) -> List[Dict[str, Any]]:
         """Extract all blocks using the EXACT working algorithm from test_all_blocks_extractor"""
         all_blocks = []
-        block_count = 0
-        
-        def dfs(bid: str, depth: int = 0) -> None:
-            nonlocal block_count
-            
-            children = _fetch_all_children(bid)
-            
-            for i, child in enumerate(children):
-                child_id = child.get("id", "unknown")[:8] + "..."
-                child_type = child.get("type", "unknown")
-                
-                metadata = _extract_block_metadata(child)
-                content = _extract_block_content(child, self.notion)
-                
-                block_record = {
-                    **metadata,
-                    **content,
-                    "depth": depth,
-                    "full_block_json": "" if not log.isEnabledFor(logging.DEBUG) else json.dumps(child, indent=2, ensure_ascii=False)
-                }
-                
-                all_blocks.append(block_record)
-                block_count += 1
-                
-                if child.get("has_children"):
-                    dfs(child["id"], depth + 1)
-        
-        dfs(page_id)
-        return all_blocks
+        debug = log.isEnabledFor(logging.DEBUG)
+        # Fetched level by level up front; the walk below keeps depth-first order
+        tree = _fetch_children_tree(page_id, failed)
 
-    def _find_technical_ecp_block(self, start_block_id: str) -> Optional[dict]:
-        """Depth-first search for the first block whose plain text starts with 'Technical ECP'."""
+        # Explicit stack instead of recursion (no recursion limit on deep
+        # pages); children are pushed reversed so they pop in document order
+        stack = [(child, 0) for child in reversed(tree.get(page_id, []))]
+        while stack:
+            child, depth = stack.pop()
 
-        def dfs(bid: str) -> Optional[dict]:
-            children = _fetch_all_children(bid)
-            for child in children:
-                text = _plain_text(child).strip()
-                if text.lower().startswith("technical ecp"):
-                    return child
-                if child.get("has_children"):
-                    found = dfs(child["id"])
-                    if found:
-                        return found
-            return None
+            metadata = _extract_block_metadata(child)
+            content = _extract_block_content(child, self.notion)
+
+            all_blocks.append({
+                **metadata,
+                **content,
+                "depth": depth,
+                "full_block_json": json.dumps(child, indent=2, ensure_ascii=False) if debug else ""
+            })
+
+            if child.get("has_children"):
+                stack.extend((grandchild, depth + 1) for grandchild in reversed(tree.get(child["id"], [])))
 
-        return dfs(start_block_id)
+        return all_blocks
 
-    def extract_technical_ecp_only(self, page_id: str) -> List[Dict[str, Any]]:
-        """Locate the 'Technical ECP' block and return that block and all of its descendants."""
+    def _find_technical_ecp_block(self, start_block_id: str, failed: Optional[List[str]] = None) -> Optional[dict]:
+        """Depth-first search for the first block whose plain text starts with 'Technical ECP'."""
 
-        target_block = self._find_technical_ecp_block(page_id)
+        # Same visiting (and fetching) order as the recursive walk: a block's
+        # subtree is searched before its next sibling
+        stack = list(reversed(_fetch_all_children(start_block_id, failed)))
+        while stack:
+            child = stack.pop()
+            text = _plain_text(child).strip()
+            if text.lower().startswith("technical ecp"):
+                return child
+            if child.get("has_children"):
+                stack.extend(reversed(_fetch_all_children(child["id"], failed)))
+        return None
+
+    def extract_technical_ecp_only(self, page_id: str, failed: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+        """Locate the 'Technical ECP' block and return that block and all of its descendants.
+
+        Blocks whose children could not be fetched are appended to *failed*.
+        """
+
+        target_block = self._find_technical_ecp_block(page_id, failed)
         if not target_block:
             return []
 
@@ -694,7 +1392,7 @@ class NotionDatabaseToCSV:
             "full_block_json": "" if not log.isEnabledFor(logging.DEBUG) else json.dumps(target_block, indent=2, ensure_ascii=False)
         })
 
-        descendant_blocks = self.extract_all_blocks_using_working_algorithm(target_block["id"])
+        descendant_blocks = self.extract_all_blocks_using_working_algorithm(target_block["id"], failed)
         for blk in descendant_blocks:
             blk["depth"] += 1
             if not log.isEnabledFor(logging.DEBUG):
@@ -726,8 +1424,41 @@ class NotionDatabaseToCSV:
         
         return cleaned.strip()
 
-    def _process_page(self, page_index: int, total_pages: int, page: dict) -> Optional[Dict[str, Any]]:
-        """Process a single Notion page and return structured data."""
+    def _page_blocks(self, page: dict, failed: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+        """``extract_technical_ecp_only`` for *page*, via the persistent cache.
+
+        A page's ``last_edited_time`` moves whenever any of its content is
+        edited, so blocks stored under the same timestamp are still current.
+        Incomplete extractions (fetch failures, cancellation) are not stored;
+        their failed block ids are also appended to *failed*, if given.
+        """
+        page_id, edited = page["id"], page.get("last_edited_time")
+        with _notion_cache_lock:
+            cache = _notion_block_cache() if edited else None
+            entry = cache.get(page_id) if cache is not None else None
+        if entry is not None and entry[0] == edited:
+            return entry[1]
+
+        page_failed: List[str] = []
+        blocks = self.extract_technical_ecp_only(page_id, page_failed)
+        if failed is not None:
+            failed.extend(page_failed)
+        if cache is not None and not page_failed and not (cancel_event and cancel_event.is_set()):
+            with _notion_cache_lock:
+                cache[page_id] = (edited, blocks)
+                cache.sync()
+        return blocks
+
+    def _process_page(self, page_index: int, total_pages: int, page: dict,
+                      failed: Optional[List[str]] = None) -> Optional[Dict[str, Any]]:
+        """Process a single Notion page and return structured data.
+
+        *page_index* is 1-based and *total_pages* is 0 when the total isn't
+        known yet (pages processed while the query is still paginating);
+        both only identify the page to the caller. Blocks that could not be
+        fetched, or the page itself if processing fails, are appended to
+        *failed*, if given.
+        """
 
         try:
             page_name = "Untitled"
@@ -755,7 +1486,7 @@ class NotionDatabaseToCSV:
                         page_name = clean_value
                         break
 
-            filtered_blocks = self.extract_technical_ecp_only(page["id"])
+            filtered_blocks = self._page_blocks(page, failed)
 
             if not filtered_blocks:
                 return None
@@ -763,12 +1494,17 @@ class NotionDatabaseToCSV:
             parameter_name = ""
             conditional_logic = []
 
+            # Read each block's fields once into parallel lists, so the scans
+            # below index lists instead of repeating dict lookups and strips
+            depths = [blk.get("depth", 0) for blk in filtered_blocks]
+            texts = [blk.get("text", "").strip() for blk in filtered_blocks]
+            types = [blk.get("type", "") for blk in filtered_blocks]
+
             i = 0
             n_blocks = len(filtered_blocks)
             while i < n_blocks:
-                blk = filtered_blocks[i]
-                text = blk.get("text", "").strip()
-                btype = blk.get("type")
+                text = texts[i]
+                btype = types[i]
 
                 if btype == "toggle" and text.lower().startswith("technical ecp parameter name"):
                     parts = text.split(":", 1)
@@ -780,7 +1516,7 @@ class NotionDatabaseToCSV:
                             parameter_name = parameter_name.replace("extension.", "")
 
                 elif btype == "toggle" and "condition" in text.lower():
-                    condition_depth = blk.get("depth", 0)
+                    condition_depth = depths[i]
                     condition_text = text.replace("[toggle]", "").strip()
                     if condition_text.lower().startswith("condition "):
                         condition_text = condition_text[10:].strip()
@@ -794,10 +1530,9 @@ class NotionDatabaseToCSV:
                     values = []
                     current_number = 1  # Simple counter for numbered items
                     
-                    while j < n_blocks and filtered_blocks[j]["depth"] > condition_depth:
-                        inner_blk = filtered_blocks[j]
-                        inner_text = inner_blk.get("text", "").strip()
-                        inner_type = inner_blk.get("type", "")
+                    while j < n_blocks and depths[j] > condition_depth:
+                        inner_text = texts[j]
+                        inner_type = types[j]
                         
                         if inner_text:
                             if inner_type == "numbered_list_item":
@@ -841,53 +1576,60 @@ class NotionDatabaseToCSV:
 
         except Exception as e:
             log.error("Error processing page %s: %s", page.get("id", "unknown"), e)
+            if failed is not None:
+                failed.append(page.get("id", "unknown"))
             return None
 
 # ---------------------------------------------------------------------------
 # Fetch ERP data
 # ---------------------------------------------------------------------------
 
-def gather_erp_data() -> List[Dict[str, Any]]:
+def gather_erp_data(prompt_name: Optional[str] = None, failed: Optional[List[Any]] = None) -> List[Dict[str, Any]]:
     """Fetch all ERP GPTPromptParameter records concurrently using a thread pool.
 
     This significantly speeds up the slow sequential network calls by
     parallelising the `fetch_one` requests.  The number of worker threads is
-    automatically chosen based on the number of IDs (capped at 32) to avoid
+    ``ERP_FETCH_WORKERS`` (but not more than the number of IDs) to avoid
     overwhelming the ERP backend.
+
+    *prompt_name* defaults to the module-level ``PROMPT_NAME``; passing it
+    explicitly keeps concurrent callers from sharing that global. ID pages
+    and records that could not be fetched are appended to *failed*, if
+    given, so callers can tell a partial result from a complete one.
     """
-    logging.info("Fetching ERP data for prompt '%s' (multithreaded)", PROMPT_NAME)
+    prompt_name = prompt_name or PROMPT_NAME
+    logging.info("Fetching ERP data for prompt '%s' (multithreaded)", prompt_name)
 
     # Early cancellation check before starting
     if cancel_event and cancel_event.is_set():
         logging.info("ERP data gathering cancelled before starting")
         return []
 
-    ids = fetch_ids()
+    ids = fetch_ids(prompt_name, failed)
     if not ids:
         logging.warning("No ERP IDs found – returning empty list")
         return []
 
-    # Thread-pool size heuristic: at most 32, but not more than len(ids)
-    max_workers = min(5, len(ids))
+    max_workers = min(ERP_FETCH_WORKERS, len(ids))
 
     records: List[Dict[str, Any]] = []
-    completed_count = 0
-    
-    progress_lock = threading.Lock()  # Thread-safe progress updates
+    # 70-80% range for ERP
+    report_progress = _progress_reporter("Fetching ERP data", 70, 10, len(ids), "Retrieved {done}/{total} ERP records")
     
     with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
         # Submit all fetch tasks first
         futures = {executor.submit(fetch_one, ident): ident for ident in ids}
 
-        # As each future completes, convert and append
-        for future in tqdm(concurrent.futures.as_completed(futures), total=len(ids), desc="ERP records"):
+        # As each future completes, convert and append. Only this loop touches
+        # the records and the progress count, so no lock is needed.
+        for completed_count, future in enumerate(
+            tqdm(concurrent.futures.as_completed(futures), total=len(ids), desc="ERP records"), 1
+        ):
             # Check cancellation more frequently
             if cancel_event and cancel_event.is_set():
                 logging.info("ERP data gathering cancelled, shutting down thread pool...")
-                # Cancel remaining futures
-                for remaining_future in futures:
-                    remaining_future.cancel()
-                executor.shutdown(wait=False)
+                # Drop every queued fetch; running ones finish on their own
+                executor.shutdown(wait=False, cancel_futures=True)
                 break
                 
             ident = futures[future]
@@ -895,20 +1637,13 @@ def gather_erp_data() -> List[Dict[str, Any]]:
                 raw = future.result()
                 converted = convert_record(raw)
                 records.append(converted)
-                
-                # Thread-safe progress update
-                with progress_lock:
-                    completed_count += 1
-                    # Update global progress if callback is available (70-80% range for ERP)
-                    if progress_callback and len(ids) > 0:
-                        progress_pct = 70 + int((completed_count / len(ids)) * 10)  # 70-80%
-                        progress_callback("Fetching ERP data", progress_pct, f"Retrieved {completed_count}/{len(ids)} ERP records")
-                    
             except Exception as e:
                 logging.error("Failed to fetch ERP ID %s: %s", ident, e)
-                # Still increment completed count for failed records to maintain progress accuracy
-                with progress_lock:
-                    completed_count += 1
+                if failed is not None:
+                    failed.append(ident)
+
+            # Failed records count too, to keep progress accurate
+            report_progress(completed_count)
 
     logging.info("Fetched %d ERP records", len(records))
     return records
@@ -917,8 +1652,24 @@ def gather_erp_data() -> List[Dict[str, Any]]:
 # Fetch Notion data
 # ---------------------------------------------------------------------------
 
-def gather_notion_data() -> List[Dict[str, Any]]:
-    logging.info("Fetching Notion data from database %s", DATABASE_URL)
+# Status/select option names (lowercased) read as "validated" / "not validated"
+_TRUTHY_LABELS = frozenset({"true", "yes", "validated", "done", "complete"})
+_FALSY_LABELS = frozenset({"false", "no", "not validated", "pending", "incomplete"})
+
+def _pick_option(prop_info: Dict[str, Any], prop_type: str, labels: frozenset, default: str) -> str:
+    """Name of the first status/select option whose lowercased name is in *labels*."""
+    options = prop_info.get(prop_type, {}).get("options", [])
+    return next((opt["name"] for opt in options if opt.get("name", "").lower() in labels), default)
+
+def gather_notion_data(database_url: Optional[str] = None, failed: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+    """Fetch and process every to-be-validated page of a Notion database.
+
+    *database_url* defaults to the module-level ``DATABASE_URL``. Pages and
+    blocks that could not be fetched are appended to *failed*, if given, so
+    callers can tell a partial result from a complete one.
+    """
+    database_url = database_url or DATABASE_URL
+    logging.info("Fetching Notion data from database %s", database_url)
     
     # Early cancellation check before starting
     if cancel_event and cancel_event.is_set():
@@ -927,7 +1678,7 @@ def gather_notion_data() -> List[Dict[str, Any]]:
         
     processor = NotionDatabaseToCSV(NOTION_TOKEN)
 
-    database_id = processor.extract_database_id_from_url(DATABASE_URL)
+    database_id = processor.extract_database_id_from_url(database_url)
     database_info = processor.notion.databases.retrieve(database_id)
 
     to_be_validated_prop = None
@@ -954,12 +1705,7 @@ def gather_notion_data() -> List[Dict[str, Any]]:
         if to_be_validated_type == "checkbox":
             to_be_validated_filter = {"property": to_be_validated_prop, "checkbox": {"equals": True}}
         elif to_be_validated_type in {"status", "select"}:
-            truthy_labels = {"true", "yes", "validated", "done", "complete"}
-            chosen = "True"
-            for opt in to_be_validated_info.get(to_be_validated_type, {}).get("options", []):
-                if opt.get("name", "").lower() in truthy_labels:
-                    chosen = opt["name"]
-                    break
+            chosen = _pick_option(to_be_validated_info, to_be_validated_type, _TRUTHY_LABELS, "True")
             to_be_validated_filter = {"property": to_be_validated_prop, to_be_validated_type: {"equals": chosen}}
         
         # Build second condition: "Technical Validated" is false
@@ -967,12 +1713,7 @@ def gather_notion_data() -> List[Dict[str, Any]]:
         if technical_validated_type == "checkbox":
             technical_validated_filter = {"property": technical_validated_prop, "checkbox": {"equals": False}}
         elif technical_validated_type in {"status", "select"}:
-            falsy_labels = {"false", "no", "not validated", "pending", "incomplete"}
-            chosen = "False"
-            for opt in technical_validated_info.get(technical_validated_type, {}).get("options", []):
-                if opt.get("name", "").lower() in falsy_labels:
-                    chosen = opt["name"]
-                    break
+            chosen = _pick_option(technical_validated_info, technical_validated_type, _FALSY_LABELS, "False")
             technical_validated_filter = {"property": technical_validated_prop, technical_validated_type: {"equals": chosen}}
         
         # Combine both conditions with AND logic
@@ -990,80 +1731,80 @@ def gather_notion_data() -> List[Dict[str, Any]]:
         if prop_type == "checkbox":
             filter_payload = {"property": to_be_validated_prop, "checkbox": {"equals": True}}
         elif prop_type in {"status", "select"}:
-            truthy_labels = {"true", "yes", "validated", "done", "complete"}
-            chosen = "True"
-            for opt in prop_info.get(prop_type, {}).get("options", []):
-                if opt.get("name", "").lower() in truthy_labels:
-                    chosen = opt["name"]
-                    break
+            chosen = _pick_option(prop_info, prop_type, _TRUTHY_LABELS, "True")
             filter_payload = {"property": to_be_validated_prop, prop_type: {"equals": chosen}}
 
+    # Pages are only read for their title, so ask Notion to return just that
+    # property instead of every column of every row
+    title_prop_ids = [
+        prop["id"] for prop in database_info.get("properties", {}).values()
+        if prop.get("type") == "title" and prop.get("id")
+    ]
+
     pages: List[Dict[str, Any]] = []
+    records: List[Dict[str, Any]] = []
     has_more = True
     cursor = None
-    while has_more:
-        # Check cancellation during page fetching
-        if cancel_event and cancel_event.is_set():
-            logging.info("Notion page fetching cancelled")
-            return []
-            
-        query_kwargs: Dict[str, Any] = {"database_id": database_id, "page_size": 100}
-        if filter_payload:
-            query_kwargs["filter"] = filter_payload
-        if cursor:
-            query_kwargs["start_cursor"] = cursor
-        resp = processor.notion.databases.query(**query_kwargs)
-        pages.extend(resp["results"])
-        has_more = resp.get("has_more", False)
-        cursor = resp.get("next_cursor")
-
-    # Process pages concurrently using thread pool
-    records: List[Dict[str, Any]] = []
-    max_workers = min(2, len(pages))  # Cap at 2 to be more respectful of Notion API rate limits
-    completed_count = 0
-    progress_lock = threading.Lock()  # Thread-safe progress updates
-    
-    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-        # Submit all page processing tasks
-        futures = {
-            executor.submit(processor._process_page, idx + 1, len(pages), page): (idx, page)
-            for idx, page in enumerate(pages)
-        }
-        
-        # Collect results as they complete
-        for future in tqdm(concurrent.futures.as_completed(futures), total=len(pages), desc="Notion pages"):
+
+    # Pages are processed concurrently using a thread pool, starting as soon
+    # as each query response arrives so pagination overlaps block fetching
+    # (the total isn't known yet, hence total_pages=0)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, NOTION_FETCH_WORKERS)) as executor:
+        futures: Dict[concurrent.futures.Future, tuple[int, dict]] = {}
+        while has_more:
+            # Check cancellation during page fetching
+            if cancel_event and cancel_event.is_set():
+                logging.info("Notion page fetching cancelled")
+                executor.shutdown(wait=False, cancel_futures=True)
+                return []
+
+            query_kwargs: Dict[str, Any] = {"database_id": database_id, "page_size": 100}
+            if filter_payload:
+                query_kwargs["filter"] = filter_payload
+            if title_prop_ids:
+                query_kwargs["filter_properties"] = title_prop_ids
+            if cursor:
+                query_kwargs["start_cursor"] = cursor
+            if not notion_limiter.acquire():
+                logging.info("Notion page fetching cancelled")
+                executor.shutdown(wait=False, cancel_futures=True)
+                return []
+            resp = processor.notion.databases.query(**query_kwargs)
+            for page in resp["results"]:
+                futures[executor.submit(processor._process_page, len(pages) + 1, 0, page, failed)] = (len(pages), page)
+                pages.append(page)
+            has_more = resp.get("has_more", False)
+            cursor = resp.get("next_cursor")
+
+        # 5-65% range for Notion, 60% of total
+        report_progress = _progress_reporter("Fetching Notion data", 5, 60, len(pages),
+                                             "Processed {done}/{total} Notion pages")
+
+        # Collect results as they complete. Only this loop touches the
+        # records and the progress count, so no lock is needed.
+        for completed_count, future in enumerate(
+            tqdm(concurrent.futures.as_completed(futures), total=len(pages), desc="Notion pages"), 1
+        ):
             # Check cancellation more frequently
             if cancel_event and cancel_event.is_set():
                 logging.info("Notion data processing cancelled, shutting down thread pool...")
-                # Cancel remaining futures
-                for remaining_future in futures:
-                    remaining_future.cancel()
-                executor.shutdown(wait=False)
+                # Drop every queued fetch; running ones finish on their own
+                executor.shutdown(wait=False, cancel_futures=True)
                 break
-                
+
             idx, page = futures[future]
             try:
                 obj = future.result()
                 if obj:
                     records.append(obj)
-                
-                # Thread-safe progress update
-                with progress_lock:
-                    completed_count += 1
-                    # Update global progress if callback is available (5-65% range for Notion, 60% of total)
-                    if progress_callback and len(pages) > 0:
-                        progress_pct = 5 + int((completed_count / len(pages)) * 60)  # 5-65%
-                        progress_callback("Fetching Notion data", progress_pct, f"Processed {completed_count}/{len(pages)} Notion pages")
-                    
-                # Small delay to be respectful of API rate limits
-                time.sleep(0.1)
-                    
             except Exception as e:
                 page_id = page.get("id", "unknown")
                 logging.error("Failed to process Notion page %s (index %d): %s", page_id, idx, e)
-                # Still increment completed count for failed pages to maintain progress accuracy
-                with progress_lock:
-                    completed_count += 1
+                if failed is not None:
+                    failed.append(page_id)
+
+            # Failed pages count too, to keep progress accurate
+            report_progress(completed_count)
     
     logging.info("Processed %d Notion pages, extracted %d records", len(pages), len(records))
     return records
@@ -1077,135 +1818,220 @@ def split_large_text(text: str, max_chars: int = 45000) -> List[str]:
     if len(text) <= max_chars:
         return [text]  # Return single item list if no splitting needed
     
+    # Walk offsets into *text* instead of re-slicing the remainder, which
+    # copied the whole tail once per chunk
     chunks = []
-    remaining = text
+    pos, length = 0, len(text)
+    # Only use a boundary if it's not too early (more than 80% into the
+    # window); searching just that tail keeps a missing boundary from
+    # scanning the whole window
+    min_offset = int(max_chars * 0.8) + 1
     
-    while remaining:
-        if len(remaining) <= max_chars:
-            chunks.append(remaining)
-            break
-            
+    while length - pos > max_chars:
         # Try to split at a reasonable boundary (like a comma or newline)
-        split_point = max_chars
+        split_point = pos + max_chars
         
         # Look for good split points (in order of preference)
-        for boundary in ['\n', ',', ' ', '"']:
-            last_boundary = remaining.rfind(boundary, 0, max_chars)
-            if last_boundary > max_chars * 0.8:  # Only use if it's not too early
+        for boundary in ('\n', ',', ' ', '"'):
+            last_boundary = text.rfind(boundary, pos + min_offset, pos + max_chars)
+            if last_boundary != -1:
                 split_point = last_boundary + 1
                 break
         
-        chunk = remaining[:split_point]
-        chunks.append(chunk)
-        remaining = remaining[split_point:]
+        chunks.append(text[pos:split_point])
+        pos = split_point
     
+    chunks.append(text[pos:])
     return chunks
 
-def create_shared_google_sheet(data_rows: List[List[str]], section_headers: List[int] = None) -> str:
-    """Create a Google Sheet with comparison data and share it with anyone who has the link."""
+def _split_sheet_batches(data_rows: List[List[str]]) -> List[tuple[int, List[List[str]]]]:
+    """Split rows into ``(start_index, rows)`` batches of at most SHEETS_BATCH_ROWS
+    rows and roughly SHEETS_BATCH_BYTES of cell text each."""
+    batches: List[tuple[int, List[List[str]]]] = []
+    start, size = 0, 0
+    for i, row in enumerate(data_rows):
+        row_size = sum(len(cell) for cell in row)
+        if i > start and (i - start >= SHEETS_BATCH_ROWS or size + row_size > SHEETS_BATCH_BYTES):
+            batches.append((start, data_rows[start:i]))
+            start, size = i, 0
+        size += row_size
+    if start < len(data_rows):
+        batches.append((start, data_rows[start:]))
+    return batches
+
+_gspread_client = None  # gspread.Client, authorized on first use
+_gspread_client_lock = threading.Lock()
+
+def _sheets_client() -> "gspread.Client":
+    """The authorized gspread client, built once and shared by every run.
+
+    The credentials refresh their access token as it expires, so later runs
+    skip re-parsing the service-account key and signing a fresh JWT.
+    """
+    global _gspread_client
+    with _gspread_client_lock:
+        if _gspread_client is None:
+            print("Setting up Google Sheets client...")
+            scopes = [
+                'https://www.googleapis.com/auth/spreadsheets',
+                'https://www.googleapis.com/auth/drive'
+            ]
+            creds = Credentials.from_service_account_info(GOOGLE_SHEETS_CREDENTIALS, scopes=scopes)
+            _gspread_client = gspread.authorize(creds)
+        return _gspread_client
+
+def create_spreadsheet() -> "gspread.Spreadsheet":
+    """Create and share an empty comparison spreadsheet with its header row and column layout.
+
+    None of this depends on the comparison rows, so callers can run it while the
+    analysis is still in progress and pass the result to create_shared_google_sheet.
+    """
+    gc = _sheets_client()
+    
+    # Create new spreadsheet
+    sheet_title = f"ERP-Notion Comparison {time.strftime('%Y-%m-%d %H:%M')}"
+    print(f"Creating spreadsheet: {sheet_title}")
+    
     try:
-        # Set up credentials and authorize
-        scopes = [
-            'https://www.googleapis.com/auth/spreadsheets',
-            'https://www.googleapis.com/auth/drive'
-        ]
-        
-        print("Setting up Google Sheets client...")
-        creds = Credentials.from_service_account_info(GOOGLE_SHEETS_CREDENTIALS, scopes=scopes)
-        gc = gspread.authorize(creds)
-        
-        # Create new spreadsheet
-        sheet_title = f"ERP-Notion Comparison {time.strftime('%Y-%m-%d %H:%M')}"
-        print(f"Creating spreadsheet: {sheet_title}")
+        spreadsheet = gc.create(sheet_title)
+        print(f"✅ Spreadsheet created with ID: {spreadsheet.id}")
+    except Exception as create_error:
+        print(f"❌ Failed to create spreadsheet:")
+        print(f"Create error: {type(create_error).__name__}: {str(create_error)}")
+        raise create_error
         
-        try:
-            spreadsheet = gc.create(sheet_title)
-            print(f"✅ Spreadsheet created with ID: {spreadsheet.id}")
-        except Exception as create_error:
-            print(f"❌ Failed to create spreadsheet:")
-            print(f"Create error: {type(create_error).__name__}: {str(create_error)}")
-            raise create_error
-            
+    worksheet = spreadsheet.sheet1
+    
+    # Add header row
+    print("Adding header row...")
+    worksheet.update('A1:F1', [['Parameter', 'Notion JSON', 'ERP JSON', 'Claude Comparison', 'Notion Boolean Error', 'ERP Boolean Error']])
+
+    # Format the header row and set column widths in one batch_update
+    print("Formatting header and applying custom column widths…")
+    sheet_id = worksheet._properties["sheetId"]
+    header_format = {
+        'backgroundColor': {'red': 0.94, 'green': 0.94, 'blue': 0.94},  # #f0f0f0
+        'textFormat': {'bold': True}
+    }
+    layout_requests = [{"repeatCell": {
+        "range": {"sheetId": sheet_id, "startRowIndex": 0, "endRowIndex": 1, "startColumnIndex": 0, "endColumnIndex": 6},
+        "cell": {"userEnteredFormat": header_format},
+        "fields": f"userEnteredFormat({','.join(header_format)})",
+    }}]
+
+    # ────────────────────────────────────────────────────────────────
+    # COLUMN WIDTH  (match historical Code.gs style)
+    # ────────────────────────────────────────────────────────────────
+    # Column pixel sizes – A:200px, B-D:400px, E-F:150px (0-based indices)
+    for idx, px in enumerate([200, 400, 400, 500, 150, 150]):  # Updated for 6 columns
+        layout_requests.append({
+            "updateDimensionProperties": {
+                "range": {
+                    "sheetId": sheet_id,
+                    "dimension": "COLUMNS",
+                    "startIndex": idx,
+                    "endIndex": idx + 1,
+                },
+                "properties": {"pixelSize": px},
+                "fields": "pixelSize",
+            }
+    })
+    
+    worksheet.spreadsheet.batch_update({"requests": layout_requests})
+
+    # Share with anyone who has the link (instead of domain restriction)
+    print("Attempting to share with anyone who has the link...")
+    try:
+        # Share with anyone who has the link (no domain restriction)
+        spreadsheet.share('', perm_type='anyone', role='reader', with_link=True)
+        print("✅ Successfully shared with anyone who has the link")
+    except Exception as share_error:
+        print(f"⚠️  Public sharing failed: {type(share_error).__name__}: {str(share_error)}")
+        print("Sheet created but not publicly shared")
+
+    return spreadsheet
+
+
+def discard_spreadsheet(spreadsheet: "gspread.Spreadsheet") -> None:
+    """Delete a spreadsheet from create_spreadsheet() that will never be populated."""
+    try:
+        spreadsheet.client.del_spreadsheet(spreadsheet.id)
+        logging.info("Deleted unused spreadsheet %s", spreadsheet.id)
+    except Exception as e:
+        logging.warning("Could not delete unused spreadsheet %s: %s", spreadsheet.id, e)
+
+
+def create_shared_google_sheet(data_rows: List[List[str]], section_headers: List[int] = None,
+                               spreadsheet: "gspread.Spreadsheet" = None) -> str:
+    """Create a Google Sheet with comparison data and share it with anyone who has the link.
+
+    Pass a spreadsheet from create_spreadsheet() to skip the setup round-trips.
+    """
+    try:
+        if spreadsheet is None:
+            spreadsheet = create_spreadsheet()
         worksheet = spreadsheet.sheet1
         
-        # Add header and data
-        print("Adding header row...")
-        worksheet.update('A1:F1', [['Parameter', 'Notion JSON', 'ERP JSON', 'Claude Comparison', 'Notion Boolean Error', 'ERP Boolean Error']])
-        
         # Add data in batches (Google Sheets API has limits)
         print(f"Adding {len(data_rows)} data rows...")
-        batch_size = 100
-        for i in range(0, len(data_rows), batch_size):
-            batch = data_rows[i:i + batch_size]
-            start_row = i + 2  # +2 because we start after header row
+        batches = _split_sheet_batches(data_rows)
+
+        def upload_batch(start: int, batch: List[List[str]]) -> None:
+            start_row = start + 2  # +2 because we start after header row
             end_row = start_row + len(batch) - 1
             range_name = f'A{start_row}:F{end_row}'  # Updated to F for 6 columns
-            worksheet.update(range_name, batch)
-            logging.info(f"Updated rows {start_row}-{end_row}")
-        
-        # Format the sheet
-        print("Formatting header...")
-        worksheet.format('A1:F1', {  # Updated to F1 for 6 columns
-            'backgroundColor': {'red': 0.94, 'green': 0.94, 'blue': 0.94},  # #f0f0f0
-            'textFormat': {'bold': True}
-        })
+            worksheet.update(range_name=range_name, values=batch)
+            logging.info("Updated rows %d-%d", start_row, end_row)
+
+        # Batches cover disjoint ranges, so they can be written in parallel
+        max_workers = max(1, min(SHEETS_UPLOAD_WORKERS, len(batches)))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(upload_batch, start, batch) for start, batch in batches]
+            for done, future in enumerate(concurrent.futures.as_completed(futures), 1):
+                future.result()
+                if progress_callback:
+                    progress_callback("Creating Google Sheet", 95 + int(done / len(futures) * 4),
+                                      f"Uploaded {done}/{len(futures)} row batches")
         
-        # ────────────────────────────────────────────────────────────────
-        # COLUMN WIDTH / ALIGNMENT / WRAP  (match historical Code.gs style)
-        # ────────────────────────────────────────────────────────────────
-        print("Applying custom column widths & wrapping…")
 
-        # Column pixel sizes – A:200px, B-D:400px, E-F:150px (0-based indices)
+        # Layout formatting goes out as one batch_update instead of a format
+        # call for the data range plus a merge and a format call per section
+        # header. Requests apply in order, so the header style overrides the wrap.
+        end_row = len(data_rows) + 1  # +1 for header
         sheet_id = worksheet._properties["sheetId"]
-        width_requests = []
-        for idx, px in enumerate([200, 400, 400, 500, 150, 150]):  # Updated for 6 columns
-            width_requests.append({
-                "updateDimensionProperties": {
-                    "range": {
-                        "sheetId": sheet_id,
-                        "dimension": "COLUMNS",
-                        "startIndex": idx,
-                        "endIndex": idx + 1,
-                    },
-                    "properties": {"pixelSize": px},
-                    "fields": "pixelSize",
-                }
-        })
-        
-        # Apply batch update for column widths
-        if width_requests:
-            worksheet.spreadsheet.batch_update({"requests": width_requests})
+
+        def row_range(start_row_index: int, end_row_index: int) -> Dict[str, int]:
+            return {"sheetId": sheet_id, "startRowIndex": start_row_index, "endRowIndex": end_row_index,
+                    "startColumnIndex": 0, "endColumnIndex": 6}
+
+        def repeat_format(grid_range: Dict[str, int], cell_format: Dict[str, Any]) -> Dict[str, Any]:
+            return {"repeatCell": {
+                "range": grid_range,
+                "cell": {"userEnteredFormat": cell_format},
+                "fields": f"userEnteredFormat({','.join(cell_format)})",
+            }}
 
         # Vertical align top & wrap text for entire data range
-        end_row = len(data_rows) + 1  # +1 for header
-        data_range = f"A1:F{end_row}"  # Updated to F for 6 columns
-        worksheet.format(data_range, {
+        format_requests = [repeat_format(row_range(0, end_row), {
             "verticalAlignment": "TOP",
             "wrapStrategy": "WRAP"
-        })
-        
+        })]
+
         # Format section headers (red highlighting, merge cells, no wrap)
         if section_headers:
             print("Formatting section headers...")
             for header_row_index in section_headers:
-                actual_row = header_row_index + 2  # +2 because we start after main header row
-                
-                # Merge cells across the row for the header
-                try:
-                    worksheet.merge_cells(f'A{actual_row}:F{actual_row}')  # Updated to F for 6 columns
-                    print(f"✅ Merged cells for section header at row {actual_row}")
-                except Exception as merge_error:
-                    print(f"⚠️ Could not merge cells for row {actual_row}: {merge_error}")
-                
-                # Apply red background and bold formatting
-                header_range = f'A{actual_row}:F{actual_row}'  # Updated to F for 6 columns
-                worksheet.format(header_range, {
+                header_range = row_range(header_row_index + 1, header_row_index + 2)  # 0-based, after main header row
+                format_requests.append({"mergeCells": {"range": header_range, "mergeType": "MERGE_ALL"}})
+                format_requests.append(repeat_format(header_range, {
                     'backgroundColor': {'red': 0.9, 'green': 0.2, 'blue': 0.2},  # Red background
                     'textFormat': {'bold': True, 'foregroundColor': {'red': 1, 'green': 1, 'blue': 1}},  # White text
                     'horizontalAlignment': 'CENTER',
                     'wrapStrategy': 'CLIP'  # No wrapping for headers
-                })
-                print(f"✅ Applied red formatting to section header at row {actual_row}")
+                }))
+        worksheet.spreadsheet.batch_update({"requests": format_requests})
+        if section_headers:
+            print(f"✅ Merged and formatted {len(section_headers)} section headers")
         
         # Add data validation with red/green dropdowns for boolean error columns
         print("Setting up red/green dropdown validation for boolean error columns...")
@@ -1325,15 +2151,6 @@ def create_shared_google_sheet(data_rows: List[List[str]], section_headers: List
         except Exception as e:
             print(f"⚠️ Could not add dropdown validation: {e}")
         
-        # Share with anyone who has the link (instead of domain restriction)
-        print("Attempting to share with anyone who has the link...")
-        try:
-            # Share with anyone who has the link (no domain restriction)
-            spreadsheet.share('', perm_type='anyone', role='reader', with_link=True)
-            print("✅ Successfully shared with anyone who has the link")
-        except Exception as share_error:
-            print(f"⚠️  Public sharing failed: {type(share_error).__name__}: {str(share_error)}")
-            print("Sheet created but not publicly shared")
         
         sheet_url = f"https://docs.google.com/spreadsheets/d/{spreadsheet.id}"
         print(f"✅ Google Sheet created: {sheet_url}")
@@ -1341,72 +2158,98 @@ def create_shared_google_sheet(data_rows: List[List[str]], section_headers: List
         return sheet_url
         
     except Exception as e:
-        logging.error(f"Failed to create Google Sheet: {e}")
-        # Fallback to local Excel file
+        logging.error("Failed to create Google Sheet: %s", e)
+        # Fallback to local Excel file. Write-only mode streams rows to disk
+        # instead of building an editable cell model of the whole sheet.
+        # openpyxl is only imported here, when Sheets has actually failed.
         from openpyxl import Workbook
-        wb = Workbook()
-        ws = wb.active
-        ws.title = "Comparison"
-        ws.append(["Parameter", "Notion JSON", "ERP JSON", "Claude Comparison"])
+        wb = Workbook(write_only=True)
+        ws = wb.create_sheet("Comparison")
+        ws.append(["Parameter", "Notion JSON", "ERP JSON", "Claude Comparison", "Notion Boolean Error", "ERP Boolean Error"])
         for row in data_rows:
             ws.append(row)
         wb.save(XLSX_OUT)
-        logging.info(f"Fallback: Local Excel file saved to {XLSX_OUT}")
+        logging.info("Fallback: Local Excel file saved to %s", XLSX_OUT)
         return str(XLSX_OUT.resolve())
 
 # ---------------------------------------------------------------------------
 # JSON Processing Helper
 # ---------------------------------------------------------------------------
 
+def dumps_pretty(obj: Any) -> str:
+    """Pretty-print *obj* as 2-space indented JSON for sheet cells.
+
+    Equivalent to ``json.dumps(obj, ensure_ascii=False, indent=2)`` but
+    serialised by orjson, which is several times faster on large configs.
+    """
+    return orjson.dumps(obj, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS).decode("utf-8")
+
 def replace_logical_operators(obj):
-    """Recursively replace || with OR and && with AND in JSON data."""
-    if isinstance(obj, dict):
-        return {key: replace_logical_operators(value) for key, value in obj.items()}
-    elif isinstance(obj, list):
-        return [replace_logical_operators(item) for item in obj]
-    elif isinstance(obj, str):
+    """Recursively replace || with OR and && with AND in JSON data.
+
+    Copy-on-write: containers with nothing to replace are returned as is
+    instead of being rebuilt, so the result must be treated as read-only.
+    The input itself is never modified (records may be cached and reused).
+    """
+    if isinstance(obj, str):
         # Replace logical operators in string values
-        return obj.replace('||', ' OR ').replace('&&', ' AND ')
+        if '||' in obj or '&&' in obj:
+            return obj.replace('||', ' OR ').replace('&&', ' AND ')
+        return obj
+    elif isinstance(obj, dict):
+        copy = None
+        for key, value in obj.items():
+            new_value = replace_logical_operators(value)
+            if new_value is not value:
+                if copy is None:
+                    copy = dict(obj)
+                copy[key] = new_value
+        return obj if copy is None else copy
+    elif isinstance(obj, list):
+        copy = None
+        for i, item in enumerate(obj):
+            new_item = replace_logical_operators(item)
+            if new_item is not item:
+                if copy is None:
+                    copy = list(obj)
+                copy[i] = new_item
+        return obj if copy is None else copy
     else:
         return obj
 
+# One pass finds every uppercase boolean; the optional ``:``/``=`` prefix marks
+# the ones in value position, which are what gets flagged as an error
+_UPPERCASE_BOOL_RE = re.compile(r"([:=]\s*)?\b(True|False|TRUE|FALSE)\b")
+
+def normalize_booleans(json_str: str) -> tuple[str, bool]:
+    """Lowercase all booleans in *json_str* in a single scan.
+
+    Returns ``(normalized, has_uppercase)`` where *has_uppercase* is what
+    ``has_uppercase_booleans`` would report for the original string.
+    """
+    if not json_str:
+        return json_str, False
+
+    found = False
+
+    def _lower(match: re.Match) -> str:
+        nonlocal found
+        if match.group(1) is not None:
+            found = True
+        return (match.group(1) or "") + match.group(2).lower()
+
+    normalized = _UPPERCASE_BOOL_RE.sub(_lower, json_str)
+    if found:
+        logging.debug("Found uppercase boolean value in %s...", json_str[:100])
+    return normalized, found
+
 def has_uppercase_booleans(json_str: str) -> bool:
     """Check if JSON string contains uppercase boolean values (True, False, TRUE, FALSE, etc.)."""
-    if not json_str:
-        return False
-        
-    import re
-    
-    # Simply check for the presence of uppercase boolean patterns
-    # We need to be very specific to avoid false positives
-    patterns = [
-        r':\s*True\b',    # ": True" (JSON value True)
-        r':\s*False\b',   # ": False" (JSON value False)  
-        r':\s*TRUE\b',    # ": TRUE" (JSON value TRUE)
-        r':\s*FALSE\b',   # ": FALSE" (JSON value FALSE)
-        r'=\s*True\b',    # "= True" (assignment True)
-        r'=\s*False\b',   # "= False" (assignment False)
-        r'=\s*TRUE\b',    # "= TRUE" (assignment TRUE)
-        r'=\s*FALSE\b',   # "= FALSE" (assignment FALSE)
-    ]
-    
-    for pattern in patterns:
-        if re.search(pattern, json_str):
-            print(f"DEBUG: Found uppercase boolean pattern: {pattern} in {json_str[:100]}...")
-            return True
-    
-    return False
+    return normalize_booleans(json_str)[1]
 
 def normalize_boolean_case(json_str: str) -> str:
     """Convert all boolean values in JSON string to lowercase."""
-    import re
-    # Replace all variations of True/False with lowercase versions
-    # Use word boundaries to avoid replacing parts of other words
-    json_str = re.sub(r'\bTrue\b', 'true', json_str)
-    json_str = re.sub(r'\bFalse\b', 'false', json_str)
-    json_str = re.sub(r'\bTRUE\b', 'true', json_str)
-    json_str = re.sub(r'\bFALSE\b', 'false', json_str)
-    return json_str
+    return normalize_booleans(json_str)[0]
 
 # ---------------------------------------------------------------------------
 # Main
@@ -1439,29 +2282,28 @@ def main() -> None:
     notion_lookup = {rec["parameter"].lower().strip(): rec for rec in notion_records if rec.get("parameter")}
     erp_lookup = {rec["parameter"].lower().strip(): rec for rec in erp_records if rec.get("parameter")}
 
-    all_params = sorted(set(notion_lookup) | set(erp_lookup))
-    logging.info("Total parameters: Notion=%d, ERP=%d, Combined=%d", len(notion_lookup), len(erp_lookup), len(all_params))
-
-    # Separate parameters by type
-    both_params = []  # Parameters in both Notion and ERP
-    notion_only_params = []  # Parameters only in Notion
-    erp_only_params = []  # Parameters only in ERP
-    
-    for param in all_params:
-        if param in notion_lookup and param in erp_lookup:
-            both_params.append(param)
-        elif param in notion_lookup:
-            notion_only_params.append(param)
-        elif param in erp_lookup:
-            erp_only_params.append(param)
-    
-    both_params.sort()
-    notion_only_params.sort()
-    erp_only_params.sort()
+    # Separate parameters by type with set operations on the key views, each
+    # group sorted once for the sheet order
+    notion_keys, erp_keys = notion_lookup.keys(), erp_lookup.keys()
+    both_params = sorted(notion_keys & erp_keys)  # Parameters in both Notion and ERP
+    notion_only_params = sorted(notion_keys - erp_keys)  # Parameters only in Notion
+    erp_only_params = sorted(erp_keys - notion_keys)  # Parameters only in ERP
+    logging.info("Total parameters: Notion=%d, ERP=%d, Combined=%d", len(notion_lookup), len(erp_lookup),
+                 len(both_params) + len(notion_only_params) + len(erp_only_params))
     
     logging.info("Parameter distribution - Both: %d, Notion-only: %d, ERP-only: %d", 
                 len(both_params), len(notion_only_params), len(erp_only_params))
 
+    # The sheet's setup round-trips (create, header, widths, share) don't
+    # depend on the rows, so they run while the comparisons are in flight
+    sheet_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    spreadsheet_future = sheet_executor.submit(create_spreadsheet)
+    sheet_executor.shutdown(wait=False)
+
+    def discard_unused_sheet(future: concurrent.futures.Future) -> None:
+        if future.exception() is None:
+            discard_spreadsheet(future.result())
+
     # Prepare data rows for Google Sheets
     data_rows = []
     section_headers = []  # Track section header row indices
@@ -1472,16 +2314,12 @@ def main() -> None:
         processed_notion_json = replace_logical_operators(notion_json) if notion_json else notion_json
 
         # Convert to pretty-printed JSON strings for Google Sheets (readable format)
-        notion_json_str = json.dumps(processed_notion_json, ensure_ascii=False, indent=2)
-        erp_json_str = json.dumps(erp_json, ensure_ascii=False, indent=2)
+        notion_json_str = dumps_pretty(processed_notion_json)
+        erp_json_str = dumps_pretty(erp_json)
         
-        # Check for uppercase booleans and normalize them
-        notion_has_uppercase = has_uppercase_booleans(notion_json_str)
-        erp_has_uppercase = has_uppercase_booleans(erp_json_str)
-        
-        # Normalize boolean case
-        notion_json_str = normalize_boolean_case(notion_json_str)
-        erp_json_str = normalize_boolean_case(erp_json_str)
+        # Check for uppercase booleans and normalize them in one pass
+        notion_json_str, notion_has_uppercase = normalize_booleans(notion_json_str)
+        erp_json_str, erp_has_uppercase = normalize_booleans(erp_json_str)
         
         # Split large JSON strings to avoid 50k character limit
         notion_chunks = split_large_text(notion_json_str)
@@ -1515,54 +2353,76 @@ def main() -> None:
             
             data_rows.append(row)
     
-    # 1. First: Parameters that exist in both sources (comparison)
-    for i, param in enumerate(tqdm(both_params, desc="Comparing matched parameters")):
-        # Check cancellation during comparison loop
+    # Offline runs can trade latency for the cheaper Message Batches API;
+    # otherwise the Claude calls are network-bound, so they run concurrently
+    verdicts: Dict[str, str] = {}
+    if CLAUDE_USE_BATCH_API and both_params:
+        verdicts = dict(zip(both_params, compare_pairs_with_batch_api(
+            [(notion_lookup[p], erp_lookup[p]) for p in both_params]
+        )))
+    elif both_params:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, CLAUDE_MAX_WORKERS)) as executor:
+            futures = {
+                executor.submit(compare_with_claude, notion_lookup[p], erp_lookup[p]): p for p in both_params
+            }
+            for i, future in enumerate(tqdm(concurrent.futures.as_completed(futures), total=len(futures),
+                                            desc="Comparing matched parameters")):
+                # Check cancellation during comparison loop
+                if cancel_event and cancel_event.is_set():
+                    logging.info("Process cancelled during comparison at %d/%d", i, len(both_params))
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    spreadsheet_future.add_done_callback(discard_unused_sheet)
+                    return
+                verdicts[futures[future]] = future.result()
+
+    # 1. First: Parameters that exist in both sources (comparison), in sorted order
+    for param in both_params:
+        add_parameter_rows(param, notion_lookup[param], erp_lookup[param], verdicts[param])
+
+    # 2. Second: Add section header for Notion-only parameters
+    if notion_only_params:
+        section_headers.append(len(data_rows))  # Record the row index for formatting
+        data_rows.append(["=== NOTION-ONLY PARAMETERS ===", "", "", "", "", ""])
+
+    for i, param in enumerate(tqdm(notion_only_params, desc="Processing Notion-only parameters")):
+        # Check cancellation
         if cancel_event and cancel_event.is_set():
-            logging.info("Process cancelled during comparison at %d/%d", i, len(both_params))
+            logging.info("Process cancelled during Notion-only processing at %d/%d", i, len(notion_only_params))
+            spreadsheet_future.add_done_callback(discard_unused_sheet)
             return
-            
+
         notion_json = notion_lookup[param]
-        erp_json = erp_lookup[param]
-        comparison_text = compare_with_claude(notion_json, erp_json)
-        
-        add_parameter_rows(param, notion_json, erp_json, comparison_text)
+        add_parameter_rows(param, notion_json, {}, "Parameter missing in ERP")
 
-            # 2. Second: Add section header for Notion-only parameters
-        if notion_only_params:
-            section_headers.append(len(data_rows))  # Record the row index for formatting
-            data_rows.append(["=== NOTION-ONLY PARAMETERS ===", "", "", "", "", ""])
-        
-        for i, param in enumerate(tqdm(notion_only_params, desc="Processing Notion-only parameters")):
-            # Check cancellation
-            if cancel_event and cancel_event.is_set():
-                logging.info("Process cancelled during Notion-only processing at %d/%d", i, len(notion_only_params))
-                return
-                
-            notion_json = notion_lookup[param]
-            add_parameter_rows(param, notion_json, {}, "Parameter missing in ERP")
+    # 3. Third: Add section header for ERP-only parameters
+    if erp_only_params:
+        section_headers.append(len(data_rows))  # Record the row index for formatting
+        data_rows.append(["=== ERP-ONLY PARAMETERS ===", "", "", "", "", ""])
 
-            # 3. Third: Add section header for ERP-only parameters
-        if erp_only_params:
-            section_headers.append(len(data_rows))  # Record the row index for formatting
-            data_rows.append(["=== ERP-ONLY PARAMETERS ===", "", "", "", "", ""])
-        
-        for i, param in enumerate(tqdm(erp_only_params, desc="Processing ERP-only parameters")):
-            # Check cancellation
-            if cancel_event and cancel_event.is_set():
-                logging.info("Process cancelled during ERP-only processing at %d/%d", i, len(erp_only_params))
-                return
-                
-            erp_json = erp_lookup[param]
-            add_parameter_rows(param, {}, erp_json, "Parameter missing in Notion")
+    for i, param in enumerate(tqdm(erp_only_params, desc="Processing ERP-only parameters")):
+        # Check cancellation
+        if cancel_event and cancel_event.is_set():
+            logging.info("Process cancelled during ERP-only processing at %d/%d", i, len(erp_only_params))
+            spreadsheet_future.add_done_callback(discard_unused_sheet)
+            return
+
+        erp_json = erp_lookup[param]
+        add_parameter_rows(param, {}, erp_json, "Parameter missing in Notion")
 
     # Final cancellation check before creating sheet
     if cancel_event and cancel_event.is_set():
         logging.info("Process cancelled before creating Google Sheet")
+        spreadsheet_future.add_done_callback(discard_unused_sheet)
         return
 
-    # Create shared Google Sheet
-    sheet_url = create_shared_google_sheet(data_rows, section_headers)
+    # Fill the sheet prepared above; if its setup failed, this retries it
+    # (or falls back to the local Excel file)
+    try:
+        spreadsheet = spreadsheet_future.result()
+    except Exception as e:
+        logging.warning("Early Google Sheet setup failed: %s", e)
+        spreadsheet = None
+    sheet_url = create_shared_google_sheet(data_rows, section_headers, spreadsheet=spreadsheet)
     logging.info("🎉 Comparison complete! Sheet URL: %s", sheet_url)
 
 
@@ -3,46 +3,74 @@
 Simple test to verify nested content extraction logic
 """
 
+import sys
+from itertools import islice, takewhile
+
+_MAX_DEPTH = 64
+
+# Precomputed indentation strings, 4 spaces per level
+_INDENTS = tuple("    " * k for k in range(_MAX_DEPTH))
+
+# Precomputed "N. " labels for numbered list items
+_NUMBER_LABELS = tuple(f"{n}. " for n in range(100))
+
+# Block type codes, resolved once per block before formatting
+_T_BULLET, _T_NUMBERED, _T_PARAGRAPH, _T_OTHER = range(4)
+_TYPE_CODES = {
+    "bulleted_list_item": _T_BULLET,
+    "numbered_list_item": _T_NUMBERED,
+    "paragraph": _T_PARAGRAPH,
+}
+
+# Numbered-item prefixes the structure validation looks for
+_NUM_PREFIXES = frozenset(("1.", "2.", "3."))
+
 def test_nested_content_recursively(blocks, start_index, target_depth):
     """Test version of the recursive function"""
     content_parts = []
-    i = start_index
-    numbered_counters = {}  # Track numbering per depth level
+    numbered_counters = [0] * _MAX_DEPTH  # Track numbering per depth level
+    prev_depth = target_depth
+    
+    # Walk only the subtree below target_depth, reading each block once
+    subtree = takewhile(lambda b, td=target_depth: b["depth"] > td, islice(blocks, start_index, None))
+    rows = [(_TYPE_CODES.get(b.get("type", ""), _T_OTHER), b.get("depth", 0), b.get("text", "").strip())
+            for b in subtree]
     
-    while i < len(blocks) and blocks[i]["depth"] > target_depth:
-        block = blocks[i]
-        block_type = block.get("type", "")
-        block_depth = block.get("depth", 0)
-        block_text = block.get("text", "").strip()
+    for type_code, block_depth, block_text in rows:
+        # Leaving a subtree restarts numbering for its deeper levels
+        if block_depth < prev_depth:
+            deeper = len(numbered_counters) - block_depth - 1
+            if deeper > 0:
+                numbered_counters[block_depth + 1:] = [0] * deeper
+        prev_depth = block_depth
         
         # Skip empty blocks
         if not block_text:
-            i += 1
             continue
         
         # Calculate indentation based on depth relative to target
         indent_level = block_depth - target_depth - 1
-        indent = "    " * indent_level  # 4 spaces per level
+        if indent_level >= _MAX_DEPTH:
+            raise ValueError(f"Nesting too deep ({indent_level} levels, max {_MAX_DEPTH - 1})")
+        indent = _INDENTS[indent_level]
         
         # Handle different block types with appropriate formatting
-        if block_type == "bulleted_list_item":
+        if type_code == _T_BULLET:
             content_parts.append(f"{indent}- {block_text}")
-        elif block_type == "numbered_list_item":
+        elif type_code == _T_NUMBERED:
             # Track numbering per depth level for proper sequential numbering
-            if block_depth not in numbered_counters:
-                numbered_counters[block_depth] = 1
-            else:
-                numbered_counters[block_depth] += 1
+            if block_depth >= len(numbered_counters):
+                numbered_counters.extend([0] * (block_depth + 1 - len(numbered_counters)))
+            numbered_counters[block_depth] += 1
             
             number = numbered_counters[block_depth]
-            content_parts.append(f"{indent}{number}. {block_text}")
-        elif block_type == "paragraph":
+            label = _NUMBER_LABELS[number] if number < len(_NUMBER_LABELS) else f"{number}. "
+            content_parts.append(f"{indent}{label}{block_text}")
+        elif type_code == _T_PARAGRAPH:
             content_parts.append(f"{indent}{block_text}")
         else:
             # For any other block type, just add the text if it exists
             content_parts.append(f"{indent}{block_text}")
-        
-        i += 1
     
     return "\n".join(content_parts)
 
@@ -83,11 +111,9 @@ def test_nested_structure():
         }
     ]
     
-    print("🔍 Testing nested content extraction...")
-    print("\nInput block structure:")
-    for i, block in enumerate(test_blocks):
-        indent = "  " * block["depth"]
-        print(f"{i}: {indent}{block['type']}: {block['text'][:50]}...")
+    out = ["🔍 Testing nested content extraction...", "\nInput block structure:"]
+    out.extend(f"{i}: {'  ' * block['depth']}{block['type']}: {block['text'][:50]}..."
+               for i, block in enumerate(test_blocks))
     
     # Test extracting content under the condition (depth 1)
     condition_depth = 1
@@ -95,37 +121,44 @@ def test_nested_structure():
     
     result = test_nested_content_recursively(test_blocks, start_index, condition_depth)
     
-    print(f"\n✅ Extracted content under condition (depth {condition_depth}):")
-    print("=" * 60)
-    print(result)
-    print("=" * 60)
+    out.append(f"\n✅ Extracted content under condition (depth {condition_depth}):")
+    out.append("=" * 60)
+    out.append(result)
+    out.append("=" * 60)
     
-    # Verify the structure
+    # Verify the structure, classifying every line in a single pass
     lines = result.split('\n')
-    print(f"\n📊 Analysis:")
-    print(f"   Total lines: {len(lines)}")
+    out.append(f"\n📊 Analysis:")
+    out.append(f"   Total lines: {len(lines)}")
     
+    has_bullet = has_numbered = has_indented_numbered = False
     for i, line in enumerate(lines):
-        if line.strip():
-            leading_spaces = len(line) - len(line.lstrip())
-            print(f"   Line {i+1}: {leading_spaces} spaces -> '{line.strip()[:40]}...'")
-    
-    # Check if numbered lists are properly nested
-    has_bullet = any(line.strip().startswith('-') for line in lines)
-    has_numbered = any(line.strip().startswith(('1.', '2.', '3.')) for line in lines)
-    has_indented_numbered = any(line.startswith('    ') and line.strip().startswith(('1.', '2.', '3.')) for line in lines)
+        unindented = line.lstrip()
+        if not unindented:
+            continue
+        leading_spaces = len(line) - len(unindented)
+        stripped = unindented.rstrip()
+        out.append(f"   Line {i+1}: {leading_spaces} spaces -> '{stripped[:40]}...'")
+        if stripped.startswith('-'):
+            has_bullet = True
+        elif stripped[:2] in _NUM_PREFIXES:
+            # Check if numbered lists are properly nested
+            has_numbered = True
+            if line.startswith('    '):
+                has_indented_numbered = True
     
-    print(f"\n🎯 Structure validation:")
-    print(f"   ✅ Has bulleted list: {has_bullet}")
-    print(f"   ✅ Has numbered lists: {has_numbered}")
-    print(f"   ✅ Has indented numbered lists: {has_indented_numbered}")
+    out.append(f"\n🎯 Structure validation:")
+    out.append(f"   ✅ Has bulleted list: {has_bullet}")
+    out.append(f"   ✅ Has numbered lists: {has_numbered}")
+    out.append(f"   ✅ Has indented numbered lists: {has_indented_numbered}")
     
-    if has_bullet and has_numbered and has_indented_numbered:
-        print(f"\n🎉 SUCCESS: Nested structure preserved correctly!")
-        return True
+    success = has_bullet and has_numbered and has_indented_numbered
+    if success:
+        out.append(f"\n🎉 SUCCESS: Nested structure preserved correctly!")
     else:
-        print(f"\n❌ FAILED: Nested structure not preserved correctly")
-        return False
+        out.append(f"\n❌ FAILED: Nested structure not preserved correctly")
+    sys.stdout.write("\n".join(out) + "\n")
+    return success
 
 if __name__ == "__main__":
     success = test_nested_structure()
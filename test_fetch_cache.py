@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+"""
+Test that incomplete Notion fetches are reported and never cached
+"""
+
+import os
+import sys
+
+# merge_compare refuses to import without these; no request is ever sent
+os.environ.setdefault("AUTH_TOKEN", "test")
+os.environ.setdefault("NOTION_TOKEN", "test")
+os.environ.setdefault("DATABASE_URL", "https://www.notion.so/" + "0" * 32)
+
+# Add the current directory to the path so we can import merge_compare
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import main
+from merge_compare import NotionDatabaseToCSV
+
+def _failing_processor(monkeypatch):
+    """A processor whose block extraction gives up on the page's children"""
+    processor = NotionDatabaseToCSV(os.environ["NOTION_TOKEN"])
+
+    def extract(page_id, failed=None):
+        failed.append(page_id)
+        return []
+
+    monkeypatch.setattr(processor, "extract_technical_ecp_only", extract)
+    return processor
+
+def test_page_blocks_reports_failures(monkeypatch):
+    """Block-fetch failures reach the caller's failed list"""
+    processor = _failing_processor(monkeypatch)
+    failed = []
+    processor._page_blocks({"id": "page-1"}, failed)
+    assert failed == ["page-1"]
+
+def test_partial_notion_fetch_is_not_cached(monkeypatch):
+    """A fetch that lost blocks is re-run instead of replayed from the cache"""
+    processor = _failing_processor(monkeypatch)
+    monkeypatch.setattr(main, "FETCH_CACHE_TTL", 60)
+    monkeypatch.setattr(main, "_fetch_cache", main.collections.OrderedDict())
+    calls = []
+
+    def fetch(failed):
+        calls.append(1)
+        processor._process_page(1, 1, {"id": "page-1", "properties": {}}, failed)
+        assert failed == ["page-1"]
+        return [{"parameter": "partial"}]
+
+    for _ in range(2):
+        records, cached = main._cached_fetch(("notion", "db"), fetch)
+        assert records == [{"parameter": "partial"}] and not cached
+    assert len(calls) == 2
+    assert not main._fetch_cache
@@ -3,6 +3,8 @@
 Test script to verify nested content extraction is working properly
 """
 
+import concurrent.futures
+import functools
 import os
 import sys
 from dotenv import load_dotenv
@@ -13,6 +15,17 @@ load_dotenv()
 # Add the current directory to the path so we can import merge_compare
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
+@functools.lru_cache(maxsize=None)
+def _get_processor(token):
+    """Build the Notion processor once per token"""
+    from merge_compare import NotionDatabaseToCSV
+    return NotionDatabaseToCSV(token)
+
+@functools.lru_cache(maxsize=None)
+def _database_id(token, database_url):
+    """Resolve the database ID once per URL"""
+    return _get_processor(token).extract_database_id_from_url(database_url)
+
 def test_nested_extraction():
     """Test the nested content extraction functionality"""
     
@@ -26,16 +39,16 @@ def test_nested_extraction():
         return False
     
     try:
-        from merge_compare import NotionDatabaseToCSV
+        from merge_compare import NOTION_FETCH_WORKERS
         
         print("🔍 Testing nested content extraction...")
         
         # Initialize the processor
-        processor = NotionDatabaseToCSV(os.getenv("NOTION_TOKEN"))
+        processor = _get_processor(os.getenv("NOTION_TOKEN"))
         
         # Extract database ID from URL
         database_url = os.getenv("DATABASE_URL")
-        database_id = processor.extract_database_id_from_url(database_url)
+        database_id = _database_id(os.getenv("NOTION_TOKEN"), database_url)
         
         print(f"📊 Database ID: {database_id}")
         
@@ -45,12 +58,16 @@ def test_nested_extraction():
         
         print(f"📄 Found {len(pages)} pages to test")
         
-        # Test processing each page
-        for i, page in enumerate(pages):
+        # Process the pages concurrently (the Notion limiter paces the calls) and report in order
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, NOTION_FETCH_WORKERS)) as executor:
+            futures = [executor.submit(processor._process_page, i+1, len(pages), page)
+                       for i, page in enumerate(pages)]
+        
+        for i, future in enumerate(futures):
             print(f"\n🔄 Testing page {i+1}...")
             
             try:
-                result = processor._process_page(i+1, len(pages), page)
+                result = future.result()
                 
                 if result:
                     print(f"✅ Parameter: {result.get('parameter', 'N/A')}")